@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compare the speed of the byte comparators with the str based
+comparison the Judge used before on generated outputs.
+
+Usage: python benchmarks/comparators.py [megabytes]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comparator import Comparator  # noqa: E402
+
+CHUNK = 65536
+
+
+def generate(size):
+    """Generate about size bytes of lines with numbers."""
+    line = b' '.join(str(n).encode('ascii') for n in range(100)) + b'\n'
+    return line * (size // len(line) + 1)
+
+
+def compare_bytes(name, out, ref):
+    comparator = Comparator.new(name, ref, 0, 1e-6)
+    view = memoryview(out)
+    for start in range(0, len(out), CHUNK):
+        if not comparator.feed(view[start:start + CHUNK].tobytes()):
+            break
+    return comparator.finish()
+
+
+def compare_files(out, ref):
+    """Compare the output with the reference line by line
+    ignoring trailing whitespace."""
+    out = out.rstrip().split('\n')
+    ref = ref.rstrip().split('\n')
+    if len(out) != len(ref):
+        return False
+    for outLine, refLine in zip(out, ref):
+        if outLine.rstrip() != refLine.rstrip():
+            return False
+    return True
+
+
+def compare_str(out, ref):
+    # The way the output was compared before, decoding included
+    return compare_files(out.decode('utf-8'), ref.decode('utf-8'))
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 \
+        else 16 * 1024 * 1024
+    ref = generate(size)
+    out = bytes(ref)
+    # A wrong answer differing in the first line
+    wrong = b'x' + out[1:]
+
+    print("Output size: {:.1f} MB".format(len(ref) / 1024.0 / 1024.0))
+    print("{:<10} {:>12} {:>12}".format("comparator", "accepted", "wrong"))
+    cases = [('str', lambda o: compare_str(o, ref))]
+    cases += [(name, lambda o, name=name: compare_bytes(name, o, ref))
+              for name in ('exact', 'lines', 'tokens', 'numeric')]
+    for name, compare in cases:
+        assert compare(out) and not compare(wrong)
+        accepted = min(timeit.repeat(lambda: compare(out), number=1, repeat=3))
+        rejected = min(timeit.repeat(lambda: compare(wrong), number=1,
+                                     repeat=3))
+        print("{:<10} {:>11.3f}s {:>11.3f}s".format(name, accepted, rejected))
+
+
+if __name__ == '__main__':
+    main()
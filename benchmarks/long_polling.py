@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Check how the Node asks the fake Supervisor for submissions. A held
+request is repeated at once, a request answered at once makes the Node
+fall back to backoff and try long-polling again later.
+
+Usage: python benchmarks/long_polling.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from settings import NODE, SUPERVISOR  # noqa: E402
+from supervisor import FakeSupervisor  # noqa: E402
+
+LONG_POLL_TIME = 0.5
+LONG_POLL_RETRY = 1.5
+
+
+def fetch(longPolling, duration):
+    """Let a Node fetch submissions from a Supervisor for the given time,
+    return the Supervisor and the Node."""
+    from node import Node
+
+    supervisor = FakeSupervisor(longPolling=longPolling)
+    supervisor.start()
+    SUPERVISOR['HOST'] = supervisor.url
+    node = Node()
+    thread = threading.Thread(target=node.fetch)
+    thread.daemon = True
+    thread.start()
+    time.sleep(duration)
+    return supervisor, node
+
+
+def check_hold():
+    supervisor, node = fetch(True, 3 * LONG_POLL_TIME)
+    waits = [wait for _, wait in supervisor.polls]
+    assert len(waits) >= 2 and set(waits) == {LONG_POLL_TIME}, waits
+    assert node.backoff.attempts == 0, node.backoff.attempts
+    # A held request gets the submission as soon as it arrives
+    submitted = time.time()
+    supervisor.submit({'id': 1})
+    submission = node.submissions.get(timeout=LONG_POLL_TIME)
+    assert submission['id'] == 1
+    print("hold -> retry: {} requests, submission after {:.3f}s".format(
+        len(waits), time.time() - submitted))
+
+
+def check_backoff():
+    supervisor, node = fetch(False, LONG_POLL_RETRY + 1)
+    waits = [wait for _, wait in supervisor.polls]
+    assert waits[0] == LONG_POLL_TIME and waits[1] == 0, waits
+    assert node.backoff.attempts > 0
+    # Long-polling is tried again once the retry time has passed
+    probes = [at for at, wait in supervisor.polls[1:] if wait]
+    assert probes and probes[0] - supervisor.polls[0][0] >= LONG_POLL_RETRY, \
+        supervisor.polls
+    print("quick 404 -> backoff: {} requests, long-polled again "
+          "after {:.3f}s".format(len(waits),
+                                 probes[0] - supervisor.polls[0][0]))
+
+
+def main():
+    workDir = tempfile.mkdtemp(prefix='zebra-long-polling-')
+    try:
+        NODE['LONG_POLL_TIME'] = LONG_POLL_TIME
+        NODE['LONG_POLL_RETRY'] = LONG_POLL_RETRY
+        NODE['QUERY_BACKOFF'] = {'BASE': 0.05, 'MAX': 0.1}
+        NODE['OUTBOX']['PATH'] = os.path.join(workDir, 'outbox')
+        NODE['METRICS']['ENABLED'] = False
+        check_hold()
+        check_backoff()
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Supervisor implementing the REST endpoints used by
+the Node. Submissions are handed out in the order they were added and the
+results sent back are collected together with the time they arrived.
+"""
+import hashlib
+import io
+import json
+import re
+import tarfile
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Empty, Queue
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+
+def build_archive(members):
+    """Return a gzipped tar archive with the given name -> bytes members
+    in their order."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+        for name, data in members.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tarinfo.mtime = int(time.time())
+            archive.addfile(tarinfo, io.BytesIO(data))
+    return buf.getvalue()
+
+
+class FakeSupervisor(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, longPolling=True):
+        HTTPServer.__init__(self, (host, port), Handler)
+        # If not set submission requests are answered at once like
+        # by a Supervisor which does not support long-polling
+        self.longPolling = longPolling
+        # (time, wait) of every submission request
+        self.polls = []
+        # (problem, test type) -> (archive, ETag, modification time)
+        self.archives = {}
+        self.submissions = Queue()
+        # Submission id -> time it was handed out to the Node
+        self.fetchTimes = {}
+        # Submission id -> (time the results arrived, results)
+        self.results = {}
+        self.bytesSent = 0
+        self._done = threading.Condition()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/rest/'.format(*self.server_address)
+
+    def add_problem(self, problem, tests, config=None):
+        """Publish the tests of the problem. Tests are given as a dict of
+        name -> (input, output, test config) and config is the problem wide
+        configuration."""
+        configs = dict((name, json.dumps(conf).encode('utf-8'))
+                       for name, (_, _, conf) in tests.items())
+        if config is not None:
+            configs['problem'] = json.dumps(config).encode('utf-8')
+        members = {
+            'input': dict((name, test[0]) for name, test in tests.items()),
+            'output': dict((name, test[1]) for name, test in tests.items()),
+            'config': configs,
+        }
+        for testType, files in members.items():
+            archive = build_archive(files)
+            self.archives[(str(problem), testType)] = (
+                archive,
+                '"{}"'.format(hashlib.sha1(archive).hexdigest()),
+                time.time()
+            )
+
+    def submit(self, submission):
+        self.submissions.put(submission)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='FakeSupervisor')
+        thread.daemon = True
+        thread.start()
+
+    def received(self, submissionId, results):
+        with self._done:
+            self.results[submissionId] = (time.time(), results)
+            self._done.notify_all()
+
+    def wait(self, count, timeout=None):
+        """Wait until results of count submissions have arrived."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._done:
+            while len(self.results) < count:
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+        return True
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.bytesSent += len(body)
+
+    def send_json(self, data):
+        self.send(200, json.dumps(data).encode('utf-8'),
+                  [('Content-Type', 'application/json')])
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path[len('/rest/'):]
+
+        if path == 'submission/for_judging/':
+            wait = float(query.get('wait', ['0'])[0])
+            self.server.polls.append((time.time(), wait))
+            if not self.server.longPolling:
+                wait = 0
+            try:
+                submission = self.server.submissions.get(timeout=wait) \
+                    if wait else self.server.submissions.get_nowait()
+            except Empty:
+                return self.send(404)
+            self.server.fetchTimes[submission['id']] = time.time()
+            return self.send_json(submission)
+
+        if path == 'problem/active/':
+            return self.send_json(sorted(set(
+                problem for problem, _ in self.server.archives)))
+
+        match = re.match(r'problem/(\w+)/test_(\w+)/$', path)
+        if match and match.groups() in self.server.archives:
+            archive, etag, mtime = self.server.archives[match.groups()]
+            headers = [('ETag', etag),
+                       ('Last-Modified', formatdate(mtime, usegmt=True))]
+            if self.headers.get('If-None-Match') == etag:
+                return self.send(304, headers=headers)
+            rangeHeader = self.headers.get('Range')
+            if rangeHeader and self.headers.get('If-Range') == etag:
+                start = int(rangeHeader.split('=')[1].rstrip('-'))
+                return self.send(206, archive[start:], headers)
+            return self.send(200, archive, headers)
+
+        self.send(404)
+
+    def do_PUT(self):
+        match = re.match(r'/rest/submission/(\w+)/', self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not match:
+            return self.send(404)
+        self.server.received(int(match.group(1)), json.loads(body))
+        self.send(200)
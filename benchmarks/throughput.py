@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Judge generated submissions end to end against a local fake Supervisor
+and report the throughput, the latency of the judging phases and the peak
+memory. Programs run as plain processes in the sandbox directories,
+without the isolation of the SELinux sandbox.
+
+The problem sums the numbers of every test. Submissions are drawn from the
+given weighted mixes of languages and verdicts, for example
+
+    python benchmarks/throughput.py --submissions 200 --workers 4 \\
+        --languages C=2,C++=1,Python=1 --verdicts ok=8,wa=1,re=1
+
+Save the report with --output and compare it with one of another commit
+by --baseline.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from settings import LANGUAGES, NODE, SUPERVISOR  # noqa: E402
+from supervisor import FakeSupervisor  # noqa: E402
+
+C_SOURCES = {
+    'ok': '#include <stdio.h>\n'
+          'int main(void) { long long n, x, s = 0; scanf("%lld", &n);\n'
+          'while (n--) { scanf("%lld", &x); s += x; }\n'
+          'printf("%lld\\n", s); return 0; }\n',
+    'wa': '#include <stdio.h>\n'
+          'int main(void) { long long n, x, s = 1; scanf("%lld", &n);\n'
+          'while (n--) { scanf("%lld", &x); s += x; }\n'
+          'printf("%lld\\n", s); return 0; }\n',
+    're': 'int main(void) { return 3; }\n',
+    'tle': 'int main(void) { volatile int x = 0; for (;;) x++; }\n',
+    'ce': 'int main(void) { return 0 }\n',
+}
+
+CPP_SOURCES = {
+    'ok': '#include <iostream>\n'
+          'int main() { long long n, x, s = 0; std::cin >> n;\n'
+          'while (n--) { std::cin >> x; s += x; }\n'
+          'std::cout << s << std::endl; }\n',
+    'wa': '#include <iostream>\n'
+          'int main() { long long n, x, s = 0; std::cin >> n;\n'
+          'while (n--) { std::cin >> x; s -= x; }\n'
+          'std::cout << s << std::endl; }\n',
+    're': 'int main() { return 3; }\n',
+    'tle': 'int main() { volatile int x = 0; for (;;) x++; }\n',
+    'ce': 'int main() { return 0 }\n',
+}
+
+SOURCES = {
+    'C': (C_SOURCES, '/* {} */\n'),
+    'C++': (CPP_SOURCES, '// {}\n'),
+    'Python': ({
+        'ok': 'import sys\n'
+              'print(sum(int(x) for x in sys.stdin.buffer.read().split()[1:]))'
+              '\n',
+        'wa': 'print(0)\n',
+        're': 'raise SystemExit(3)\n',
+        'tle': 'while True:\n    pass\n',
+        'ce': 'def main(:\n',
+    }, '# {}\n'),
+}
+
+PROBLEM = '1'
+
+
+def parse_mix(value):
+    """Parse 'a=2,b=1' into a list of (name, weight)."""
+    mix = []
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def pick(rng, mix):
+    names, weights = zip(*mix)
+    return rng.choices(names, weights)[0]
+
+
+def generate_tests(rng, count, numbers, timeLimit, memoryLimit):
+    tests = {}
+    for number in range(count):
+        values = [rng.randint(-10 ** 9, 10 ** 9) for _ in range(numbers)]
+        data = '{}\n{}\n'.format(numbers, ' '.join(map(str, values)))
+        tests[str(number)] = (
+            data.encode('ascii'),
+            '{}\n'.format(sum(values)).encode('ascii'),
+            {'memory': memoryLimit, 'time': timeLimit, 'sample': 0},
+        )
+    return tests
+
+
+def verdict(results):
+    """Classify the results the way the Supervisor would."""
+    if not results or any(result.get('compilationError')
+                          for result in results):
+        return 'ce'
+    if all(result['mark'] for result in results):
+        return 'ok'
+    if any(result['returncode'] == 9 for result in results):
+        return 'tle'
+    if any(result['returncode'] not in (0, None) for result in results):
+        return 're'
+    return 'wa'
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99),
+            'max': values[-1], 'count': len(values)}
+
+
+def configure(args, workDir):
+    """Point the Node at the fake Supervisor and the work directory."""
+    NODE['WORKERS'] = args.workers
+    NODE['TEST_WORKERS'] = args.test_workers
+    NODE['TEST_BACKEND'] = 'rest'
+    NODE['TEST_PATH'] = os.path.join(workDir, 'tests')
+    NODE['COMPILATION_CACHE']['PATH'] = os.path.join(workDir, 'cache')
+    NODE['RUNTIME_PATH'] = os.path.join(workDir, 'runtime')
+    NODE['OUTBOX']['PATH'] = os.path.join(workDir, 'outbox')
+    NODE['PREFETCH']['ENABLED'] = args.prefetch
+    NODE['METRICS']['ENABLED'] = False
+    NODE['METRICS']['TRACE_DIR'] = os.path.join(workDir, 'traces')
+    NODE['SANDBOX']['HOME_DIR'] = os.path.join(workDir, 'home')
+    NODE['SANDBOX']['TMP_DIR'] = os.path.join(workDir, 'tmp')
+    if args.workspace_root is not None:
+        NODE['SANDBOX']['WORKSPACE_ROOT'] = args.workspace_root or None
+
+
+def install_process_sandbox():
+    """Make the Node run the programs as plain processes. The sandbox
+    module reads the settings when imported, so it is called after
+    configure."""
+    from sandbox import Sandbox, SELinuxSandbox
+
+    class ProcessSandbox(SELinuxSandbox):
+        """Runs the programs in the sandbox directories, limited only by
+        the measuring helper. It does not isolate them from the system."""
+
+        @property
+        def sandboxCmd(self):
+            return 'env -C {home} HOME={home} TMPDIR={tmp}'.format(
+                home=self.homeDir, tmp=self.tmpDir)
+
+    Sandbox.new = staticmethod(lambda name=None: ProcessSandbox(name))
+
+
+def phase_latencies(traceDir):
+    phases = {}
+    for name in os.listdir(traceDir):
+        with open(os.path.join(traceDir, name)) as traceFile:
+            trace = json.load(traceFile)
+        for phase in trace['phases']:
+            key = phase['phase']
+            if phase.get('language'):
+                key = '{}[{}]'.format(key, phase['language'])
+            phases.setdefault(key, []).append(phase['duration'])
+    return dict((key, percentiles(values))
+                for key, values in sorted(phases.items()))
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    languages = [(name, weight) for name, weight in parse_mix(args.languages)
+                 if name in SOURCES and
+                 shutil.which(LANGUAGES[name]['compiler'])]
+    if not languages:
+        sys.exit("None of the languages has sources and its compiler "
+                 "installed.")
+
+    workDir = tempfile.mkdtemp(prefix='zebra-benchmark-')
+    configure(args, workDir)
+    install_process_sandbox()
+    # The Node modules read the settings when imported
+    from node import Node
+
+    supervisor = FakeSupervisor()
+    SUPERVISOR['HOST'] = supervisor.url
+    supervisor.add_problem(PROBLEM, generate_tests(
+        rng, args.tests, args.numbers, args.time_limit, args.memory_limit))
+
+    expected = {}
+    for number in range(args.submissions):
+        language = pick(rng, languages)
+        kind = pick(rng, parse_mix(args.verdicts))
+        sources, comment = SOURCES[language]
+        source = sources[kind]
+        if not args.duplicates:
+            # Keep the compilation cache from serving the next submissions
+            source = comment.format(number) + source
+        supervisor.submit({'id': number + 1, 'problem': PROBLEM,
+                           'language': language, 'source': source,
+                           'active': 0})
+        expected[number + 1] = (language, kind)
+
+    supervisor.start()
+    node = Node()
+    startTime = time.time()
+    thread = threading.Thread(target=node.run, name='Node')
+    thread.daemon = True
+    thread.start()
+    finished = supervisor.wait(args.submissions, args.timeout)
+    elapsed = time.time() - startTime
+
+    latencies = []
+    mismatches = {}
+    for submissionId, (language, kind) in expected.items():
+        if submissionId not in supervisor.results:
+            continue
+        arrivalTime, data = supervisor.results[submissionId]
+        latencies.append(arrivalTime - supervisor.fetchTimes[submissionId])
+        got = 'error' if data['error'] else verdict(data['results'])
+        if got != kind:
+            key = '{} {} -> {}'.format(language, kind, got)
+            mismatches[key] = mismatches.get(key, 0) + 1
+
+    report = {
+        'commit': commit(),
+        'config': dict(vars(args), languages=dict(languages)),
+        'finished': finished,
+        'judged': len(supervisor.results),
+        'elapsed': elapsed,
+        'throughput': len(supervisor.results) / elapsed,
+        'latency': percentiles(latencies),
+        'phases': phase_latencies(NODE['METRICS']['TRACE_DIR']),
+        'mismatches': mismatches,
+        'downloaded': supervisor.bytesSent,
+        # Kilobytes on Linux
+        'peakMemory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peakChildMemory':
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+    if args.keep:
+        print("Work directory kept in {}.".format(workDir))
+    else:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return report
+
+
+def print_report(report, baseline=None):
+    def change(value, key):
+        if baseline is None or not baseline.get(key):
+            return ''
+        return ' ({:+.1%})'.format(value / baseline[key] - 1)
+
+    print("Commit:      {}".format(report['commit']))
+    print("Judged:      {} in {:.2f}s{}".format(
+        report['judged'], report['elapsed'],
+        '' if report['finished'] else ' (timed out)'))
+    print("Throughput:  {:.2f} submissions/s{}".format(
+        report['throughput'], change(report['throughput'], 'throughput')))
+    print("Peak memory: {} kB node, {} kB programs".format(
+        report['peakMemory'], report['peakChildMemory']))
+    print("Downloaded:  {} bytes".format(report['downloaded']))
+    print("")
+    print("{:<24} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+        'latency', 'count', 'p50', 'p90', 'p99', 'max'))
+    rows = [('end to end', report['latency'])]
+    rows += sorted(report['phases'].items())
+    for name, stats in rows:
+        if not stats:
+            continue
+        print("{:<24} {:>8} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>8.3f}s".format(
+            name, stats['count'], stats['p50'], stats['p90'], stats['p99'],
+            stats['max']))
+    if report['mismatches']:
+        print("")
+        print("Unexpected verdicts:")
+        for key, count in sorted(report['mismatches'].items()):
+            print("  {:<30} {}".format(key, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--submissions', type=int, default=50)
+    parser.add_argument('--languages', default='C=1,C++=1,Python=1',
+                        help="weighted mix of LANGUAGES")
+    parser.add_argument('--verdicts', default='ok=7,wa=1,re=1,ce=1',
+                        help="weighted mix of ok, wa, re, tle and ce")
+    parser.add_argument('--tests', type=int, default=10,
+                        help="number of tests of the problem")
+    parser.add_argument('--numbers', type=int, default=1000,
+                        help="numbers in the input of every test")
+    parser.add_argument('--time-limit', type=int, default=1)
+    parser.add_argument('--memory-limit', type=int, default=512 * 1024,
+                        help="in kilobytes")
+    parser.add_argument('--workers', type=int, default=NODE['WORKERS'])
+    parser.add_argument('--test-workers', type=int,
+                        default=NODE['TEST_WORKERS'])
+    parser.add_argument('--duplicates', action='store_true',
+                        help="submit identical sources for the same "
+                             "language and verdict")
+    parser.add_argument('--prefetch', action='store_true')
+    parser.add_argument('--workspace-root',
+                        help="RAM-backed workspace folder, empty to disable")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the work directory with the traces")
+    parser.add_argument('--output', help="save the report as JSON")
+    parser.add_argument('--baseline', help="report saved by --output "
+                                           "to compare with")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+
+    report = run(args)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(report, outputFile, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+#-*- coding: utf8 -*-
+from settings import NODE, LANGUAGES
+from result import Compilation
+from collections import OrderedDict
+import os
+import shutil
+import tempfile
+import hashlib
+import codecs
+import threading
+import logging
+
+
+class CompilationCache(object):
+    """On-disk cache of compiled programs and the outcomes of compilation.
+    Entries are keyed by the hash of the source, the compiler configuration
+    and the compiler binary and evicted in least recently used order once
+    the cache grows over the configured size. The lock guards only the
+    index, files are copied outside of it."""
+
+    LOG_NAME = 'compilation.log'
+    RETURNCODE_NAME = 'returncode'
+    FILES_DIR = 'files'
+
+    # Compiler command -> identity of its binary, see _compiler_identity
+    _compilers = {}
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self._entries = None
+        # Key -> number of restores of the entry in progress, such entries
+        # are not evicted
+        self._restoring = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    @staticmethod
+    def key(source, language):
+        """Hash the source together with everything affecting
+        the compilation result."""
+        sha = hashlib.sha256()
+        compiler = LANGUAGES[language].get('compiler')
+        for part in (language,
+                     compiler,
+                     CompilationCache._compiler_identity(compiler),
+                     LANGUAGES[language].get('compilerOptions'),
+                     source):
+            sha.update(part.encode('utf-8'))
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    @classmethod
+    def _compiler_identity(cls, compiler):
+        """Return the path, size and modification time of the compiler
+        binary, so that the entries of an upgraded compiler are not used."""
+        identity = cls._compilers.get(compiler)
+        if identity is None:
+            path = shutil.which(compiler)
+            if path is None:
+                identity = ''
+            else:
+                path = os.path.realpath(path)
+                stat = os.stat(path)
+                identity = '{} {} {}'.format(path, stat.st_size,
+                                             stat.st_mtime)
+            cls._compilers[compiler] = identity
+        return identity
+
+    def _load(self):
+        """Index the existing entries, oldest used first."""
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        entries = []
+        for key in os.listdir(self.path):
+            entryPath = os.path.join(self.path, key)
+            if key.startswith('.') or not os.path.exists(
+                    os.path.join(entryPath, self.RETURNCODE_NAME)):
+                # Unfinished entry left by a killed Node or an entry
+                # without the return code saved by an older one
+                shutil.rmtree(entryPath, ignore_errors=True)
+                continue
+            entries.append(
+                (os.path.getmtime(entryPath), key, self._size(entryPath))
+            )
+        for mtime, key, size in sorted(entries):
+            self._entries[key] = size
+
+    @staticmethod
+    def _size(path):
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                size += os.path.getsize(os.path.join(root, name))
+        return size
+
+    def restore(self, key, dirName):
+        """Copy the cached files into the given directory and return
+        the Compilation or None if there is no such entry."""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                return None
+            # Mark as recently used
+            self._entries[key] = self._entries.pop(key)
+            self._restoring[key] = self._restoring.get(key, 0) + 1
+
+        entryPath = os.path.join(self.path, key)
+        try:
+            filesPath = os.path.join(entryPath, self.FILES_DIR)
+            for name in os.listdir(filesPath):
+                source = os.path.join(filesPath, name)
+                if os.path.isdir(source):
+                    shutil.copytree(source, os.path.join(dirName, name))
+                else:
+                    shutil.copy2(source, os.path.join(dirName, name))
+            with codecs.open(os.path.join(entryPath, self.LOG_NAME),
+                             'r', 'utf-8') as logFile:
+                log = logFile.read()
+            with open(os.path.join(entryPath, self.RETURNCODE_NAME),
+                      'r') as returncodeFile:
+                returncode = int(returncodeFile.read())
+            os.utime(entryPath, None)
+        finally:
+            with self._lock:
+                self._restoring[key] -= 1
+                if not self._restoring[key]:
+                    del self._restoring[key]
+
+        logging.info("Compilation cache hit {}.".format(key))
+        return Compilation(returncode, log)
+
+    def store(self, key, dirName, compilation, exclude=()):
+        """Save the files from the given directory and the return code
+        and log of the Compilation as the entry for the key."""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                return
+
+        # Build the entry aside and rename it so that it appears at once
+        tmpPath = tempfile.mkdtemp(prefix='.' + key, dir=self.path)
+        shutil.copytree(
+            dirName,
+            os.path.join(tmpPath, self.FILES_DIR),
+            ignore=lambda path, names: [n for n in names
+                                        if path == dirName and
+                                        n in exclude]
+        )
+        with codecs.open(os.path.join(tmpPath, self.LOG_NAME),
+                         'w', 'utf-8') as logFile:
+            logFile.write(compilation.log)
+        with open(os.path.join(tmpPath, self.RETURNCODE_NAME),
+                  'w') as returncodeFile:
+            returncodeFile.write(str(compilation.returncode))
+        size = self._size(tmpPath)
+
+        with self._lock:
+            if key in self._entries:
+                # Stored by another worker meanwhile
+                evicted = [tmpPath]
+            else:
+                os.rename(tmpPath, os.path.join(self.path, key))
+                self._entries[key] = size
+                evicted = self._evict()
+        for path in evicted:
+            shutil.rmtree(path, ignore_errors=True)
+
+        logging.info("Compilation result stored in cache as {}.".format(key))
+
+    def _evict(self):
+        """Remove the least recently used entries, except those being
+        restored, until the cache fits in its size limit. The entries are
+        renamed aside, return their paths to be deleted without the lock."""
+        evicted = []
+        total = sum(self._entries.values())
+        for key in list(self._entries)[:-1]:
+            if total <= self.maxSize:
+                break
+            if key in self._restoring:
+                continue
+            size = self._entries.pop(key)
+            path = tempfile.mkdtemp(prefix='.evicted-', dir=self.path)
+            os.rename(os.path.join(self.path, key),
+                      os.path.join(path, key))
+            evicted.append(path)
+            total -= size
+            logging.info("Compilation cache entry {} evicted.".format(key))
+        return evicted
+
+
+class ResultCache(object):
+    """In-memory cache of the results of judged submissions, so that
+    resubmissions and rejudges of identical sources are not judged again.
+    Entries are keyed by the hash of the submission, the language
+    configuration and the version of the tests, those of a problem whose
+    tests have changed are dropped. The least recently used entries are
+    evicted once there are more than maxEntries of them."""
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        # Key -> (problem, results, compilation log)
+        self._entries = OrderedDict()
+        # Version of the tests of every problem with cached entries
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxEntries > 0
+
+    @staticmethod
+    def key(submission, version):
+        """Hash the submission together with everything
+        affecting its results."""
+        sha = hashlib.sha256()
+        language = submission['language']
+        for part in (CompilationCache.key(submission['source'], language),
+                     LANGUAGES[language].get('runCommand'),
+                     str(bool(int(submission['active']))),
+                     str(submission['problem']),
+                     repr(version)):
+            sha.update(part.encode('utf-8'))
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def _check_version(self, problem, version):
+        """Drop the entries of the problem made with other tests."""
+        if self._versions.get(problem, version) != version:
+            for key in [key for key, entry in self._entries.items()
+                        if entry[0] == problem]:
+                del self._entries[key]
+            logging.info("Cached results of problem {} dropped, "
+                         "its tests have changed.".format(problem))
+        self._versions[problem] = version
+
+    def get(self, submission, version):
+        """Return the results and the compilation log of an identical
+        submission judged with the same tests, None if there is none."""
+        if not self.enabled or version is None:
+            return None
+
+        key = self.key(submission, version)
+        with self._lock:
+            self._check_version(submission['problem'], version)
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            # Mark as recently used
+            self._entries[key] = entry
+
+        logging.info("Result cache hit {}.".format(key))
+        return entry[1], entry[2]
+
+    def put(self, submission, version, results, log):
+        """Save the results and the compilation log of the submission
+        judged with the tests of the given version."""
+        if not self.enabled or version is None or results is None:
+            return
+
+        key = self.key(submission, version)
+        with self._lock:
+            self._check_version(submission['problem'], version)
+            self._entries.pop(key, None)
+            self._entries[key] = (submission['problem'], results, log)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+            problems = set(entry[0] for entry in self._entries.values())
+            for problem in list(self._versions):
+                if problem not in problems:
+                    del self._versions[problem]
+
+
+compilationCache = CompilationCache(
+    NODE['COMPILATION_CACHE']['PATH'],
+    NODE['COMPILATION_CACHE']['MAX_SIZE']
+)
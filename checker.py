@@ -0,0 +1,131 @@
+#-*- coding: utf8 -*-
+from settings import LANGUAGES, NODE
+from sandbox import Sandbox
+import runtime
+import os
+import shutil
+import tarfile
+import logging
+
+
+class Checker(object):
+    """Special judge program of a problem. It is delivered as a single source
+    file in the checker archive, compiled once for every version of the
+    archive and run as `checker input output reference` for every test.
+    The output is accepted if the checker exits with code 0."""
+
+    BUILD_DIR = 'build'
+
+    def __init__(self, problem, archivePath, storePath):
+        self.problem = problem
+        self.archivePath = archivePath
+        self.storePath = storePath
+        self.language = None
+        self.fileName = None
+
+    @staticmethod
+    def _language(fileName):
+        """Find the language of the source file by its extension."""
+        extension = fileName.rsplit('.', 1)[-1]
+        for language, settings in LANGUAGES.items():
+            sourceFilename = settings.get('sourceFilename')
+            if not callable(sourceFilename) and \
+               sourceFilename.rsplit('.', 1)[-1] == extension:
+                return language
+        if extension == 'java':
+            return 'Java'
+        raise TypeError("Checker language not recognized: {}.".format(
+            fileName))
+
+    @property
+    def buildPath(self):
+        return os.path.join(self.storePath, self.BUILD_DIR)
+
+    def prepare(self):
+        """Compile the checker unless it has been already compiled
+        from the current archive."""
+        with tarfile.open(self.archivePath, mode='r') as archive:
+            tarinfo = next(t for t in archive if t.isfile())
+            source = archive.extractfile(tarinfo).read().decode('utf-8')
+            self.fileName = os.path.basename(tarinfo.name)
+        self.language = self._language(self.fileName)
+
+        if os.path.exists(self.buildPath) and \
+           os.path.getmtime(self.storePath) >= \
+           os.path.getmtime(self.archivePath):
+            return
+
+        logging.info("Compiling checker for problem {}.".format(self.problem))
+        name, extension = self.fileName.rsplit('.', 1)
+        cmd = '{compiler} {compilerOptions} {fileName}.{fileExtension}'.format(
+            compiler=LANGUAGES[self.language].get('compiler'),
+            compilerOptions=LANGUAGES[self.language].get('compilerOptions'),
+            fileName=name,
+            fileExtension=extension
+        )
+
+        with Sandbox.new('checker_{}'.format(self.problem)) as sandbox:
+            with sandbox.file(self.fileName) as sourceFile:
+                sourceFile.write(source)
+            (out, err), returncode, usage = sandbox.execute(
+                cmd,
+                None,
+                timeLimit=NODE['SANDBOX']['COMPILER_TIMELIMIT']
+            )
+            if returncode != 0:
+                raise RuntimeError(
+                    "Checker compilation failed: {} {}".format(
+                        out.decode('utf-8', 'replace'),
+                        err.decode('utf-8', 'replace')))
+
+            tmpPath = self.storePath + '.tmp'
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            shutil.copytree(sandbox.homeDir,
+                            os.path.join(tmpPath, self.BUILD_DIR))
+        shutil.rmtree(self.storePath, ignore_errors=True)
+        os.rename(tmpPath, self.storePath)
+
+    def install(self, sandbox):
+        """Copy the compiled checker into the sandbox."""
+        for name in os.listdir(self.buildPath):
+            source = os.path.join(self.buildPath, name)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(sandbox.homeDir, name))
+            else:
+                shutil.copy2(source, os.path.join(sandbox.homeDir, name))
+
+    def check(self, sandbox, name, inputPath, reference):
+        """Run the checker installed in the sandbox against the output
+        file with the given name and return if it has been accepted."""
+        inputName = 'input_{}'.format(name)
+        referenceName = 'reference_{}'.format(name)
+        outputName = 'output_{}'.format(name)
+        shutil.copyfile(inputPath, os.path.join(sandbox.homeDir, inputName))
+        with open(os.path.join(sandbox.homeDir, referenceName),
+                  'wb') as referenceFile:
+            referenceFile.write(reference)
+
+        fileName, fileExtension = self.fileName.rsplit('.', 1)
+        cmd = '{run} {input} {output} {reference}'.format(
+            run=runtime.format_command(
+                LANGUAGES[self.language].get('runCommand'),
+                self.language,
+                fileName=fileName,
+                fileExtension=fileExtension,
+                sandboxHome=sandbox.homeDir,
+            ),
+            input=inputName,
+            output=outputName,
+            reference=referenceName
+        )
+        (out, err), returncode, usage = sandbox.execute(
+            cmd,
+            None,
+            timeLimit=NODE['SANDBOX']['CHECKER_TIMELIMIT'],
+            memoryLimit=NODE['SANDBOX']['CHECKER_MEMORYLIMIT']
+        )
+
+        for fileName in (inputName, referenceName, outputName):
+            os.remove(os.path.join(sandbox.homeDir, fileName))
+
+        return returncode == 0
@@ -0,0 +1,202 @@
+#-*- coding: utf8 -*-
+import re
+
+
+class Comparator(object):
+    """Compares the program output with the reference output without
+    decoding them. The output is fed in chunks while the program runs,
+    feed returns False once the output is known to be wrong or exceeds
+    the reference by the margin. The verdict is given by finish."""
+
+    def __init__(self, reference, margin):
+        self.limit = len(reference) + margin
+        self.size = 0
+        self.correct = True
+        # Set when the program has been stopped before it finished
+        self.aborted = False
+
+    def feed(self, chunk):
+        """Compare the next chunk of the output, return False
+        if the output is already known to be wrong."""
+        if not self.correct:
+            return False
+
+        self.size += len(chunk)
+        if self.size > self.limit or not self._feed(chunk):
+            self.correct = False
+        return self.correct
+
+    def _feed(self, chunk):
+        raise NotImplementedError()
+
+    def finish(self):
+        """Compare the rest of the output and return the verdict."""
+        if self.correct:
+            self.correct = self._finish()
+        return self.correct
+
+    def _finish(self):
+        raise NotImplementedError()
+
+    @staticmethod
+    def new(name, reference, margin, tolerance=None):
+        """Create a comparator by its name given in the problem config."""
+        if name == 'exact':
+            return ExactComparator(reference, margin)
+        elif name == 'tokens':
+            return TokenComparator(reference, margin)
+        elif name == 'numeric':
+            return NumericComparator(reference, margin, tolerance)
+        elif name in (None, 'lines'):
+            return LineComparator(reference, margin)
+        raise TypeError("Comparator not recognized: {}.".format(name))
+
+
+class ExactComparator(Comparator):
+    """Requires the output to be byte for byte equal to the reference."""
+
+    def __init__(self, reference, margin):
+        super(ExactComparator, self).__init__(reference, margin)
+        self.reference = memoryview(reference)
+
+    def _feed(self, chunk):
+        start = self.size - len(chunk)
+        return self.reference[start:self.size] == chunk
+
+    def _finish(self):
+        return self.size == len(self.reference)
+
+
+class LineComparator(Comparator):
+    """Compares the output line by line with the reference ignoring
+    trailing whitespace, also of the whole output."""
+
+    def __init__(self, reference, margin):
+        super(LineComparator, self).__init__(reference, margin)
+        self.reference = reference
+        # Lines of the reference are found one by one from the offset,
+        # it is past the end once all of them have been compared
+        self.end = len(reference.rstrip())
+        self.offset = 0
+        # Pieces of the output line not terminated yet
+        self.partial = []
+
+    def _feed(self, chunk):
+        if b'\n' not in chunk:
+            self.partial.append(chunk)
+            return True
+        lines = chunk.split(b'\n')
+        self.partial.append(lines[0])
+        lines[0] = b''.join(self.partial)
+        self.partial = [lines.pop()]
+        for line in lines:
+            if not self._compare(line):
+                return False
+        return True
+
+    def _compare(self, line):
+        line = line.rstrip()
+        if self.offset <= self.end:
+            lineEnd = self.reference.find(b'\n', self.offset, self.end)
+            if lineEnd == -1:
+                lineEnd = self.end
+            same = line == self.reference[self.offset:lineEnd].rstrip()
+            self.offset = lineEnd + 1
+        else:
+            # Only empty lines may follow the reference
+            same = not line
+        return same
+
+    def _finish(self):
+        correct = self._compare(b''.join(self.partial)) and \
+            self.offset > self.end
+        self.partial = []
+        return correct
+
+
+class TokenComparator(Comparator):
+    """Compares whitespace separated tokens of the output and the reference,
+    the amount and kind of whitespace does not matter."""
+
+    def __init__(self, reference, margin):
+        super(TokenComparator, self).__init__(reference, margin)
+        self.refTokens = reference.split()
+        self.token = 0
+        self.buffer = b''
+
+    def _feed(self, chunk):
+        tokens = (self.buffer + chunk).split()
+        # The last token may continue in the next chunk
+        if tokens and not chunk[-1:].isspace():
+            self.buffer = tokens.pop()
+        else:
+            self.buffer = b''
+        end = self.token + len(tokens)
+        if tokens == self.refTokens[self.token:end]:
+            # Equal tokens are compared at once
+            self.token = end
+            return True
+        for token in tokens:
+            if not self._compare(token):
+                return False
+        return True
+
+    def _compare(self, token):
+        if self.token >= len(self.refTokens):
+            return False
+        same = self._equal(token, self.refTokens[self.token])
+        self.token += 1
+        return same
+
+    def _equal(self, token, refToken):
+        return token == refToken
+
+    def _finish(self):
+        if self.buffer and not self._compare(self.buffer):
+            return False
+        self.buffer = b''
+        return self.token == len(self.refTokens)
+
+
+class NumericComparator(TokenComparator):
+    """Token comparator which accepts numbers differing from the reference
+    by at most the absolute or relative tolerance."""
+
+    NUMBER = re.compile(br'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+    def __init__(self, reference, margin, tolerance):
+        super(NumericComparator, self).__init__(reference, margin)
+        self.tolerance = 1e-6 if tolerance is None else float(tolerance)
+
+    def _equal(self, token, refToken):
+        if token == refToken:
+            return True
+        if not self.NUMBER.match(token) or not self.NUMBER.match(refToken):
+            return False
+        value, refValue = float(token), float(refToken)
+        return abs(value - refValue) <= \
+            self.tolerance * max(1.0, abs(refValue))
+
+
+class OutputFile(object):
+    """Stores the fed program output in a file for a checker.
+    Feeding stops being accepted once the output exceeds the limit."""
+
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        self.size = 0
+        self.file = open(path, 'wb')
+        self.aborted = False
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.limit:
+            return False
+        self.file.write(chunk)
+        return True
+
+    def finish(self):
+        """Close the file and return whether the output fit in the limit."""
+        self.file.close()
+        return self.size <= self.limit
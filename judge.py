@@ -3,18 +3,32 @@
 
 from six import itervalues
 from math import ceil
+from multiprocessing.pool import ThreadPool
 from settings import LANGUAGES, NODE
 from sandbox import Sandbox
-from result import Result
+from cache import compilationCache
+from metrics import measure, CACHE_REQUESTS
+from comparator import Comparator, OutputFile
+from result import Result, Compilation
+import runtime
 import threading
 import logging
+import signal
+import os
 
 
 class Judge(threading.Thread):
     """Compiles, executes and checks solutions for a specific task."""
 
-    def __init__(self, task, submission):
+    def __init__(self, task, submission, sandboxName=None, trace=None,
+                 tests=None):
         self.task = task
+        # AsyncResult of the tests being prepared while the source compiles,
+        # if None the tests are taken from the task when they are needed
+        self.tests = tests
+        self.sandboxName = sandboxName
+        # Timeline of the judging phases, see metrics.Trace
+        self.trace = trace
         self.language = submission['language']
         fileName = LANGUAGES[self.language].get('sourceFilename')
         if callable(fileName):
@@ -22,7 +36,8 @@ class Judge(threading.Thread):
         self.fileFullName = fileName
         self.fileName, self.fileExtension = fileName.split('.')
         self._results = []
-        self._compilation_log = None
+        self.compilation = None
+        self._startupTime = 0
         self.source = submission['source']
 
         # If the submission was sent in an active contest
@@ -32,35 +47,30 @@ class Judge(threading.Thread):
 
     def run(self):
         """Process the judge request - create the sandbox,
-        compile the source, execute and generate results."""
+        compile the source, execute and generate results.
+        Programs which failed to compile are not executed."""
 
-        with Sandbox.new() as sandbox:
+        with Sandbox.new(self.sandboxName) as sandbox:
             with sandbox.file(self.fileFullName) as sourceFile:
                 sourceFile.write(self.source)
-            self.compile(sandbox)
-            self.execute(sandbox)
-
-    def compare_files(self, out, ref=None):
-        """Basic comparation function.
-        Compares output file with reference file."""
-
-        out = out.rstrip()
-        ref = ref.rstrip()
-        out = out.split('\n')
-        ref = ref.split('\n')
-        if len(out) != len(ref):
-            return False
-        for outLine, refLine in zip(out, ref):
-            if outLine.rstrip() != refLine.rstrip():
-                return False
-        return True
-
-    def check_solution(self, out, ref=None, fun=compare_files):
-        """Compare solution with chosen function."""
-        return fun(self, out, ref)
+            with measure('compile', self.trace, language=self.language):
+                self.compilation = self.compile(sandbox)
+            if self.compilation.succeeded:
+                self.execute(sandbox)
+            else:
+                self.reject()
 
     def compile(self, sandbox):
-        """Compile source code and save compile logs"""
+        """Compile source code and return the Compilation. Programs compiled
+        before are copied from the compilation cache instead."""
+        key = compilationCache.key(self.source, self.language)
+        compilation = compilationCache.restore(key, sandbox.homeDir)
+        if compilation is not None:
+            CACHE_REQUESTS.inc(cache='compilation', result='hit')
+            logging.info("Compiled program taken from the cache.")
+            return compilation
+        CACHE_REQUESTS.inc(cache='compilation', result='miss')
+
         logging.info("Compiling the submission source.")
         cmd = '{compiler} {compilerOptions} {fileName}.{fileExtension}'.format(
             compiler=LANGUAGES[self.language].get('compiler'),
@@ -69,56 +79,205 @@ class Judge(threading.Thread):
             fileExtension=self.fileExtension
         )
 
-        ret = sandbox.execute(
+        output, returncode, usage = sandbox.execute(
             cmd,
             None,
             timeLimit=NODE['SANDBOX']['COMPILER_TIMELIMIT']
         )
 
-        self._compilation_log = u'{} {}'.format(*ret[0])
-        logging.info("Compilation finished.")
+        log = u'{} {}'.format(
+            *[s.decode('utf-8', 'replace') for s in output]
+        )
+        limit = NODE['COMPILATION_LOG_LIMIT']
+        if len(log) > limit:
+            log = log[:limit] + u'\n[{} more characters truncated]'.format(
+                len(log) - limit)
+        compilation = Compilation(returncode, log, usage.wallTime)
+        compilationCache.store(
+            key, sandbox.homeDir, compilation,
+            exclude=(self.fileFullName,)
+        )
+        logging.info("Compilation finished with code {}.".format(returncode))
+        return compilation
 
     def execute(self, sandbox):
         """Run program with all tests available for specific task
-        and compare using check_solution. Program is limited by execution time
-        and memory depending od information taken from the task."""
+        and compare the outputs using the comparator or the checker of
+        the task. Program is limited by execution time and memory
+        depending od information taken from the task.
+        Tests are run concurrently if NODE['TEST_WORKERS'] allows it."""
         logging.info("Executing the submission.")
-        executionPath = LANGUAGES[self.language].get('runCommand').format(
+
+        tests = self.select_tests()
+        checker = self.task.checker
+        self._startupTime = runtime.startup_time(self.language, sandbox)
+
+        if checker is not None:
+            # Outputs are judged by the problem checker in its own sandbox
+            name = 'checker' if sandbox.name is None else \
+                '{}_checker'.format(sandbox.name)
+            with Sandbox.new(name) as checkerSandbox:
+                checker.install(checkerSandbox)
+                self.execute_tests(sandbox, tests, checker, checkerSandbox)
+        else:
+            self.execute_tests(sandbox, tests)
+        logging.info("Execution finished.")
+
+    def select_tests(self):
+        """Wait for the tests of the task and return the ones
+        the submission is judged with."""
+        with measure('tests', self.trace):
+            allTests = self.task.tests if self.tests is None \
+                else self.tests.get()
+            return [test for test in itervalues(allTests)
+                    if test.isSampleTest or not self.sampleTests]
+
+    def reject(self):
+        """Give every test the compilation error result without running
+        anything. Only the test configs are waited for, if possible."""
+        logging.info("Compilation failed, the submission is not executed.")
+        flags = None if self.tests is None else self.task.sample_flags()
+        if flags is None:
+            flags = [test.isSampleTest for test in self.select_tests()]
+        self._results = [Result(None, 0, 0, compilationError=True)
+                         for sample in flags
+                         if sample or not self.sampleTests]
+
+    def execute_tests(self, sandbox, tests, checker=None,
+                      checkerSandbox=None):
+        """Run the program with the given tests, concurrently if
+        NODE['TEST_WORKERS'] allows it."""
+
+        # Groups in which a test has failed, their other tests are skipped
+        self._failedGroups = set()
+        self._groupsLock = threading.Lock()
+
+        if NODE['TEST_WORKERS'] > 1 and len(tests) > 1:
+            pool = ThreadPool(min(NODE['TEST_WORKERS'], len(tests)))
+            try:
+                # Each test gets its own copy of the compiled program
+                self._results = pool.map(
+                    lambda args: self.execute_test(
+                        sandbox.clone(args[0]), args[1], args[0],
+                        checker, checkerSandbox, isolated=True),
+                    enumerate(tests)
+                )
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self._results = [
+                self.execute_test(sandbox, test, number,
+                                  checker, checkerSandbox)
+                for number, test in enumerate(tests)
+            ]
+
+    def execute_test(self, sandbox, test, number, checker=None,
+                     checkerSandbox=None, isolated=False):
+        """Run the program with a single test and return its result.
+        If isolated is set the sandbox is created just for this test."""
+
+        group = self.group(test, number)
+        if group is not None:
+            with self._groupsLock:
+                if group in self._failedGroups:
+                    return Result(None, 0, 0, skipped=True)
+
+        result = self.run_test(sandbox, test, number, checker,
+                               checkerSandbox, isolated)
+
+        if group is not None and not result.mark:
+            with self._groupsLock:
+                self._failedGroups.add(group)
+        return result
+
+    def group(self, test, number):
+        """Return the group whose other tests may be skipped if the test
+        fails, according to the problem scoring mode. Return None if the
+        test does not allow skipping anything."""
+        scoring = self.task.config.get('scoring', 'all')
+        if scoring == 'problem':
+            return 'problem'
+        elif scoring == 'groups':
+            return test.group if test.group is not None else number
+        return None
+
+    def run_test(self, sandbox, test, number, checker=None,
+                 checkerSandbox=None, isolated=False):
+        """Execute the test and check the output."""
+
+        if isolated:
+            with sandbox:
+                return self.run_test(sandbox, test, number,
+                                     checker, checkerSandbox)
+
+        executionPath = runtime.format_command(
+            LANGUAGES[self.language].get('runCommand'),
+            self.language,
             fileName=self.fileName,
             fileExtension=self.fileExtension,
-            sandboxHome=NODE['SANDBOX']['HOME_DIR'],
+            sandboxHome=sandbox.homeDir,
         )
 
-        for test in itervalues(self.task.tests):
-            if not test.isSampleTest and self.sampleTests:
-                continue
-
-            (out, err), returncode, runTime = sandbox.execute(
+        if checker is not None:
+            # The output is saved for the checker
+            comparator = OutputFile(
+                os.path.join(checkerSandbox.homeDir,
+                             'output_{}'.format(number)),
+                len(test.output) + NODE['OUTPUT_MARGIN']
+            )
+        else:
+            # The output is compared while the program is running
+            comparator = Comparator.new(
+                self.task.config.get('comparator'),
+                test.output,
+                NODE['OUTPUT_MARGIN'],
+                self.task.config.get('tolerance')
+            )
+        with measure('run', self.trace, language=self.language):
+            (out, err), returncode, usage = sandbox.execute(
                 executionPath,
                 test.input,
+                inputFile=test.inputPath,
                 timeLimit=int(ceil(test.timeLimit)),
-                memoryLimit=test.memoryLimit
+                memoryLimit=test.memoryLimit,
+                outputChecker=comparator
             )
 
-            if not returncode == 0:
-                runTime = 0
-
-            if runTime > test.timeLimit:
-                returncode = 9
+        if comparator.aborted:
+            # The program was killed because of a wrong answer
+            returncode = 0
 
-            res = Result(
-                returncode,
-                int(self.check_solution(out, test.output) and returncode != 9),
-                runTime)
-            del out
-            self._results.append(res)
-        logging.info("Execution finished.")
+        runTime = usage.userTime
+        if runTime >= test.timeLimit or returncode == -signal.SIGXCPU:
+            # Over the limit, also if killed on reaching the CPU limit
+            returncode = 9
+        elif not returncode == 0:
+            runTime = 0
 
         if err:
             logging.warning("There were errors during execution:\n{}".format(
-                err
+                err.decode('utf-8', 'replace')
             ))
 
+        correct = comparator.finish()
+        if checker is not None:
+            if correct and returncode == 0:
+                with measure('check', self.trace):
+                    correct = checker.check(checkerSandbox, number,
+                                            test.inputPath, test.output)
+            else:
+                os.remove(comparator.path)
+
+        return Result(
+            returncode,
+            int(correct and returncode != 9),
+            runTime,
+            systemTime=usage.systemTime,
+            wallTime=usage.wallTime,
+            memory=usage.memory,
+            startupTime=self._startupTime if runTime else 0)
+
     @property
     def results(self):
         """Return compiler logs and results"""
@@ -128,6 +287,6 @@ class Judge(threading.Thread):
 
     @property
     def compilation_log(self):
-        if not self._compilation_log:
+        if self.compilation is None or not self.compilation.log:
             return None
-        return self._compilation_log
+        return self.compilation.log
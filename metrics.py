@@ -0,0 +1,259 @@
+#-*- coding: utf8 -*-
+from settings import NODE
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from contextlib import contextmanager
+from time import time
+import os
+import json
+import socket
+import threading
+import logging
+
+
+class Metric(object):
+    """Base class of the metrics exposed in the Prometheus text format.
+    Values are kept separately for every combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(name, value.replace('\\', '\\\\')
+                             .replace('"', '\\"'))
+            for name, value in pairs) + '}'
+
+    def samples(self):
+        """Return the (suffix, labels, value) triples of the metric."""
+        with self._lock:
+            return [('', self._format_labels(key), value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, labels,
+                                            repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value which goes up and down. If a function is given the value is
+    taken from it when the metrics are rendered."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), function=None):
+        super(Gauge, self).__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception as e:
+                logging.warning("Cannot read {}: {}".format(self.name, e))
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, 120)
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= bound)
+                      for c, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, (counts, total, count) in items:
+            for bound, bucketCount in zip(self.buckets, counts):
+                samples.append(('_bucket', self._format_labels(
+                    key, [('le', repr(float(bound)))]), bucketCount))
+            samples.append(('_bucket', self._format_labels(
+                key, [('le', '+Inf')]), count))
+            samples.append(('_sum', self._format_labels(key), total))
+            samples.append(('_count', self._format_labels(key), count))
+        return samples
+
+
+REGISTRY = []
+
+PHASE_LATENCY = Histogram(
+    'zebra_phase_seconds',
+    'Latency of the phases of fetching, judging and reporting submissions.',
+    ['phase', 'language'])
+SANDBOX_SPAWN = Histogram(
+    'zebra_sandbox_spawn_seconds',
+    'Time needed to start a process in the sandbox.',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+CACHE_REQUESTS = Counter(
+    'zebra_cache_requests_total',
+    'Cache lookups by cache and result.',
+    ['cache', 'result'])
+BYTES_TRANSFERRED = Counter(
+    'zebra_transferred_bytes_total',
+    'Bytes exchanged with the Supervisor.',
+    ['direction'])
+SUBMISSIONS = Counter(
+    'zebra_submissions_total',
+    'Judged submissions by outcome.',
+    ['outcome'])
+# The values of the gauges are read from the functions set by the Node
+QUEUE_DEPTH = Gauge(
+    'zebra_queue_depth',
+    'Submissions fetched and waiting for a worker.')
+IN_PROGRESS = Gauge(
+    'zebra_submissions_in_progress',
+    'Submissions being judged.')
+OUTBOX_PENDING = Gauge(
+    'zebra_outbox_pending',
+    'Results waiting to be sent to the Supervisor.')
+TASK_CACHE_SIZE = Gauge(
+    'zebra_task_cache_bytes',
+    'Size of the tests kept in memory.')
+PREFETCH_WARMTH = Gauge(
+    'zebra_prefetch_warmth',
+    'Fraction of the prefetched problems whose tests are up-to-date.')
+
+
+@contextmanager
+def measure(phase, trace=None, **labels):
+    """Measure the time of the block as the given phase of the submission
+    and record it in the trace if one is given."""
+    startTime = time()
+    try:
+        yield
+    finally:
+        duration = time() - startTime
+        PHASE_LATENCY.observe(duration, phase=phase, **labels)
+        if trace is not None:
+            trace.record(phase, startTime, duration, **labels)
+
+
+def render():
+    """Return all the metrics in the Prometheus text format."""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class Trace(object):
+    """Timeline of the phases of judging a single submission, dumped as
+    a JSON file to NODE['METRICS']['TRACE_DIR']."""
+
+    def __init__(self, submissionId):
+        self.submissionId = submissionId
+        self.startTime = time()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def record(self, phase, startTime, duration, **info):
+        with self._lock:
+            self.phases.append(dict(
+                phase=phase,
+                start=startTime - self.startTime,
+                duration=duration,
+                **info
+            ))
+
+    def dump(self):
+        traceDir = NODE['METRICS']['TRACE_DIR']
+        if traceDir is None:
+            return
+        if not os.path.exists(traceDir):
+            os.makedirs(traceDir)
+        path = os.path.join(traceDir, '{}.json'.format(self.submissionId))
+        with open(path, 'w') as traceFile:
+            json.dump({'submission': self.submissionId,
+                       'start': self.startTime,
+                       'phases': self.phases}, traceFile, indent=2)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format % args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """Serves the metrics on /metrics in a background thread."""
+
+    daemon_threads = True
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='Metrics')
+        thread.daemon = True
+        thread.start()
+        logging.info("Metrics available on port {}.".format(
+            self.server_address[1]))
+
+
+def start_server():
+    """Start the metrics endpoint configured in NODE['METRICS'], return
+    None if it cannot be started, e.g. when the port is taken. The Node
+    judges without the endpoint then."""
+    try:
+        server = MetricsServer(
+            (NODE['METRICS']['HOST'], NODE['METRICS']['PORT']),
+            MetricsHandler
+        )
+    except (socket.error, OSError) as e:
+        logging.error("Cannot serve the metrics on port {}: {}".format(
+            NODE['METRICS']['PORT'], e))
+        return None
+    server.start()
+    return server
@@ -1,12 +1,22 @@
 #! /usr/bin/env python
 #-*- coding: utf8 -*-
 from judge import Judge
-from utils import get_free_memory
-from task import Task
+from utils import get_free_memory, Backoff
+from task import TaskCache
+from cache import ResultCache
+from prefetch import Prefetcher
+from outbox import Outbox
+import runtime
+from metrics import measure, Trace, CACHE_REQUESTS
+import metrics
 from settings import NODE
-from rest import RESTConnection, UnauthorizedException, NotFoundException
+from rest import RESTConnection, UnauthorizedException, NotFoundException, \
+    ConnectionFailedException, UnknownErrorException
+from six.moves.queue import Queue
+from multiprocessing.pool import ThreadPool
 from time import time, sleep
 from xml.sax.saxutils import escape
+import threading
 import logging
 
 
@@ -14,42 +24,97 @@ class Node(object):
     """Manage the connection to the Supervisor and process judge requests."""
 
     def __init__(self):
-        self.tasks = dict()
+        self.tasks = TaskCache(
+            NODE['TASK_CACHE']['MAX_SIZE'],
+            NODE['TASK_CACHE']['MIN_FREE_MEMORY']
+        )
+        self.submissions = Queue()
+        # Every free slot corresponds to an idle worker
+        self.freeWorkers = threading.Semaphore(NODE['WORKERS'])
+        self.inProgress = dict()
+        # Brings the tests up-to-date while the submissions are compiled
+        self.testPool = ThreadPool(NODE['WORKERS'])
+        self.backoff = Backoff(
+            NODE['QUERY_BACKOFF']['BASE'],
+            NODE['QUERY_BACKOFF']['MAX']
+        )
+        # Time after which the submission requests are long-polled again
+        self.longPollTime = 0
+        self.prefetcher = Prefetcher(self.tasks)
+        self.results = ResultCache(NODE['RESULT_CACHE_SIZE'])
+        self.outbox = Outbox(NODE['OUTBOX']['PATH'])
+
+        metrics.QUEUE_DEPTH.function = self.submissions.qsize
+        metrics.IN_PROGRESS.function = lambda: len(self.inProgress)
+        metrics.OUTBOX_PENDING.function = lambda: len(self.outbox)
+        metrics.TASK_CACHE_SIZE.function = lambda: self.tasks.size
+        metrics.PREFETCH_WARMTH.function = self.prefetcher.warmth
 
     def get_task(self, pid):
         """Check if a task with specified problem id is already in tasks
-        dictionary and if not get it."""
+        cache and if not get it. Least recently used tasks are evicted
+        if there is not enough memory."""
 
-        if pid not in self.tasks:
-            self.tasks[pid] = Task.new(pid)
+        return self.tasks.get(pid)
 
-        task = self.tasks[pid]
-        task.lastUseTime = time()
+    @staticmethod
+    def prepare_tests(task, trace=None):
+        """Download and load the tests of the task if they are not
+        up-to-date and return them."""
+        with measure('sync', trace):
+            return task.tests
 
-        # Check if there is enough memory
-        # if not remove the last recently used task
-
-        return task
-
-    def judge(self, submission):
+    def judge(self, submission, sandboxName=None, trace=None):
         logging.info(
             "Starting to judge submission: "
             "id {id} pid {problem} language {language}.".format(**submission)
         )
-        task = self.get_task(submission['problem'])
-        judge = Judge(task, submission)
-        judge.start()
-        judge.join()
+        with measure('get_task', trace):
+            task = self.get_task(submission['problem'])
+        # The tests are synchronized at the same time as the source is
+        # compiled, the judge waits for them before the execution
+        tests = self.testPool.apply_async(self.prepare_tests, (task, trace))
+
+        version = None
+        if self.results.enabled and task.version is not None:
+            # The tests have been loaded before, once they are checked
+            # the results of an identical submission may be reused
+            tests.get()
+            version = task.version
+            cached = self.results.get(submission, version)
+            if cached is not None:
+                CACHE_REQUESTS.inc(cache='result', result='hit')
+                logging.info("Results of submission {id} taken from the "
+                             "cache.".format(**submission))
+                return cached
+            CACHE_REQUESTS.inc(cache='result', result='miss')
+
+        with measure('judge', trace, language=submission['language']):
+            judge = Judge(task, submission, sandboxName, trace, tests)
+            judge.start()
+            judge.join()
 
         logging.info("Judging of submission {id} finished.".format(
             **submission
         ))
+        # The tests could have been loaded, check the limits again
+        self.tasks.evict()
+        logging.info("Task cache: {hits} hits, {misses} misses, "
+                     "{evictions} evictions.".format(**self.tasks.stats))
+
+        if version is None:
+            # The tests have been loaded for this submission
+            version = task.version
+        if task.version == version:
+            self.results.put(submission, version, judge.results,
+                             judge.compilation_log)
 
         return (judge.results, judge.compilation_log)
 
     def post_results(self, results, submission):
+        """Put the results into the outbox to be sent in the background."""
 
-        logging.info("Sending the judging results.")
+        logging.info("Queuing the judging results.")
 
         results, compilelog = results
 
@@ -59,50 +124,155 @@ class Node(object):
             'results': [result.__dict__ for result in results]
         }
 
-        RESTConnection.post_submission(submission['id'], data)
+        self.outbox.put(submission['id'], data)
 
     def report_judging_error(self, submission):
         logging.info("Reporting the error...")
-        RESTConnection.post_submission(submission['id'], {'error': True, })
+        try:
+            self.outbox.put(submission['id'], {'error': True, })
+        except Exception as e:
+            logging.error("The error could not be reported: {}".format(e))
+
+    def process(self, submission, sandboxName=None):
+        """Judge the submission and send the results to the Supervisor."""
+
+        trace = Trace(submission['id']) \
+            if NODE['METRICS']['TRACE_DIR'] is not None else None
+        try:
+            results = self.judge(submission, sandboxName, trace)
+        except Exception as e:
+            logging.error(
+                "There was an error during judging: {}".format(e)
+            )
+            metrics.SUBMISSIONS.inc(outcome='error')
+            self.report_judging_error(submission)
+        else:
+            try:
+                with measure('post_results', trace):
+                    self.post_results(results, submission)
+            except Exception as e:
+                logging.error(
+                    "There was an error during result posting: {}".format(e)
+                )
+                metrics.SUBMISSIONS.inc(outcome='error')
+                self.report_judging_error(submission)
+            else:
+                metrics.SUBMISSIONS.inc(outcome='judged')
+
+        if trace is not None:
+            try:
+                trace.dump()
+            except Exception as e:
+                logging.warning("Trace could not be saved: {}".format(e))
+
+    def work(self, number):
+        """Worker loop. Take submissions from the local queue and judge them
+        in a sandbox owned by this worker."""
+
+        while True:
+            submission = self.submissions.get()
+            self.inProgress[number] = submission
+            try:
+                self.process(submission, sandboxName=number)
+            finally:
+                del self.inProgress[number]
+                self.submissions.task_done()
+                self.freeWorkers.release()
+            logging.info("Worker {} is ready for the next submission.".format(
+                number
+            ))
+
+    def start_workers(self):
+        """Start the configured number of judging workers."""
+
+        for number in range(NODE['WORKERS']):
+            worker = threading.Thread(
+                target=self.work,
+                args=(number,),
+                name='Worker-{}'.format(number)
+            )
+            worker.daemon = True
+            worker.start()
 
     def run(self):
-        """Start the Node daemon. Try to judge a submission
-        then sleep and repeat."""
+        """Start the Node daemon. Wait for an idle worker, try to get
+        a submission for it, then sleep and repeat."""
+
+        logging.info("Node has been started with {} workers.".format(
+            NODE['WORKERS']
+        ))
+        runtime.prepare()
+        self.start_workers()
+        if NODE['METRICS']['ENABLED']:
+            metrics.start_server()
+        # Results left from the previous run are sent too
+        self.outbox.start()
+        if NODE['PREFETCH']['ENABLED']:
+            self.prefetcher.start()
 
-        logging.info("Node has been started.")
+        try:
+            self.fetch()
+        except KeyboardInterrupt:
+            self.terminate()
+            raise
+
+    def fetch(self):
+        """Fill the local submission queue whenever a worker is idle."""
 
         while True:
+            # Wait until there is a worker able to judge the submission
+            self.freeWorkers.acquire()
+            wait = None
+            if NODE['LONG_POLL_TIME'] > 0 and time() >= self.longPollTime:
+                wait = NODE['LONG_POLL_TIME']
+            requestTime = time()
             try:
-                submission = RESTConnection.get_submission()
+                with measure('get_submission'):
+                    submission = RESTConnection.get_submission(wait)
             except NotFoundException:
+                self.freeWorkers.release()
+                if wait and time() - requestTime >= wait / 2.0:
+                    # The Supervisor held the request, ask again at once
+                    continue
+                if wait:
+                    logging.info(
+                        "Supervisor does not hold the requests, falling back "
+                        "to backoff for {}s.".format(NODE['LONG_POLL_RETRY'])
+                    )
+                    self.longPollTime = time() + NODE['LONG_POLL_RETRY']
                 # No submissions then wait and retry
-                logging.info("No submission to judge. Waiting...")
-                sleep(NODE['QUERY_TIME'])
+                delay = self.backoff.next()
+                logging.info(
+                    "No submission to judge. Waiting {:.2f}s...".format(delay)
+                )
+                sleep(delay)
                 continue
             except UnauthorizedException:
                 # Session expired or node was unauthorized retry
                 logging.warning("Node unauthorized. Waiting...")
+                self.freeWorkers.release()
                 sleep(NODE['QUERY_TIME'])
                 continue
-
-            try:
-                results = self.judge(submission)
-            except Exception as e:
-                logging.error(
-                    "There was an error during judging: {}".format(e)
+            except (ConnectionFailedException, UnknownErrorException):
+                # Supervisor unavailable, try again later
+                self.freeWorkers.release()
+                delay = self.backoff.next()
+                logging.warning(
+                    "Supervisor unavailable. Waiting {:.2f}s...".format(delay)
                 )
-                self.report_judging_error(submission)
-            except KeyboardInterrupt:
-                logging.info("Node termination requested.")
-                self.report_judging_error(submission)
-                raise
-            else:
-                try:
-                    self.post_results(results, submission)
-                except Exception as e:
-                    logging.error(
-                        "There was an error during result posting: {}".format(e)
-                    )
-                    self.report_judging_error(submission)
+                sleep(delay)
+                continue
 
+            self.backoff.reset()
+            self.submissions.put(submission)
             logging.info("Performing the next request.")
+
+    def terminate(self):
+        """Notify the Supervisor about the submissions which
+        will not be judged because of the Node termination."""
+
+        logging.info("Node termination requested.")
+        for submission in list(self.inProgress.values()):
+            self.report_judging_error(submission)
+        while not self.submissions.empty():
+            self.report_judging_error(self.submissions.get())
@@ -0,0 +1,121 @@
+#-*- coding: utf8 -*-
+from settings import NODE
+from rest import RESTConnection, ConnectionFailedException
+from utils import Backoff
+from metrics import measure
+from time import time, sleep
+import os
+import json
+import threading
+import logging
+
+
+class Outbox(threading.Thread):
+    """Journal of judging results waiting to be sent to the Supervisor.
+    Results are saved on disk first and sent by a background thread which
+    retries with backoff, so neither judging waits for the Supervisor nor
+    results are lost when the Node is restarted."""
+
+    def __init__(self, path):
+        threading.Thread.__init__(self, name='Outbox')
+        self.daemon = True
+        self.path = path
+        self.failedPath = os.path.join(path, 'failed')
+        self.backoff = Backoff(
+            NODE['OUTBOX']['BACKOFF']['BASE'],
+            NODE['OUTBOX']['BACKOFF']['MAX']
+        )
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        for path in (self.path, self.failedPath):
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def put(self, submissionId, data):
+        """Save the data to be sent as the submission results."""
+        with self._lock:
+            self._counter += 1
+            # Names keep the order in which the results were judged
+            name = '{:017.6f}-{:06d}-{}.json'.format(
+                time(), self._counter, submissionId)
+        entry = {'id': submissionId, 'data': data, 'attempts': 0}
+        self._write(os.path.join(self.path, name), entry)
+        self._pending.set()
+
+    @staticmethod
+    def _write(path, entry):
+        """Write the entry so that it is either whole on disk or missing."""
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as entryFile:
+            json.dump(entry, entryFile)
+            entryFile.flush()
+            os.fsync(entryFile.fileno())
+        os.rename(tmpPath, path)
+
+    def pending(self):
+        """Return the paths of the entries waiting to be sent."""
+        return [os.path.join(self.path, name)
+                for name in sorted(os.listdir(self.path))
+                if name.endswith('.json')]
+
+    def __len__(self):
+        return len(self.pending())
+
+    def send(self, path):
+        """Send a single entry, return False if the Supervisor rejected it
+        and it should be retried later. ConnectionFailedException is raised
+        if the Supervisor is unavailable, it does not count as an attempt."""
+        with open(path, 'r') as entryFile:
+            entry = json.load(entryFile)
+        try:
+            with measure('send'):
+                RESTConnection.post_submission(entry['id'], entry['data'])
+        except ConnectionFailedException:
+            raise
+        except Exception as e:
+            entry['attempts'] += 1
+            logging.warning(
+                "Sending results of submission {} failed ({} attempts): "
+                "{}".format(entry['id'], entry['attempts'], e)
+            )
+            if entry['attempts'] >= NODE['OUTBOX']['MAX_ATTEMPTS']:
+                logging.error(
+                    "Giving up sending results of submission {}.".format(
+                        entry['id'])
+                )
+                os.rename(path, os.path.join(self.failedPath,
+                                             os.path.basename(path)))
+                return True
+            self._write(path, entry)
+            return False
+        os.remove(path)
+        return True
+
+    def run(self):
+        """Send the pending entries one by one while there are any."""
+        while True:
+            self._pending.wait(NODE['OUTBOX']['BACKOFF']['MAX'])
+            self._pending.clear()
+
+            # Entries rejected in this round are retried in the next one,
+            # so that they do not hold up the others
+            rejected = set()
+            while True:
+                # Entries put meanwhile are picked up by the next listing
+                paths = [path for path in self.pending()
+                         if path not in rejected]
+                if not paths:
+                    break
+                try:
+                    for path in paths:
+                        if not self.send(path):
+                            rejected.add(path)
+                except ConnectionFailedException as e:
+                    # The Supervisor is unavailable, wait with the rest
+                    logging.warning(
+                        "Cannot send the results: {}".format(e))
+                    sleep(self.backoff.next())
+                    self._pending.set()
+                    break
+                self.backoff.reset()
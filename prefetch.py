@@ -0,0 +1,82 @@
+#-*- coding: utf8 -*-
+from settings import NODE
+from rest import RESTConnection, NotFoundException
+from utils import RateLimiter
+from multiprocessing.pool import ThreadPool
+from time import time, sleep
+import threading
+import logging
+
+
+class Prefetcher(threading.Thread):
+    """Keeps the tests of the active problems and of the recently judged
+    ones up-to-date in the background, so that submissions do not wait for
+    test downloads. Downloads are limited in concurrency and bandwidth."""
+
+    def __init__(self, tasks):
+        threading.Thread.__init__(self, name='Prefetcher')
+        self.daemon = True
+        self.tasks = tasks
+        self.rateLimiter = None
+        if NODE['PREFETCH']['BANDWIDTH']:
+            self.rateLimiter = RateLimiter(NODE['PREFETCH']['BANDWIDTH'])
+        # State of every prefetched problem: 'warm', 'cold' or 'error'
+        self.state = dict()
+        self.syncTime = dict()
+
+    def problems(self):
+        """Return the problems whose tests should be kept warm."""
+        problems = set()
+        try:
+            problems.update(RESTConnection.get_active_problems())
+        except NotFoundException:
+            pass
+        except Exception as e:
+            logging.warning("Cannot get active problems: {}".format(e))
+        # Problems judged recently are likely to be judged again
+        problems.update(self.tasks.problems())
+        return sorted(problems)
+
+    def prefetch(self, problem):
+        """Bring the tests of the problem up-to-date."""
+        startTime = time()
+        try:
+            self.tasks.warm(problem).warm(self.rateLimiter)
+        except NotFoundException:
+            logging.warning("Problem {} has no tests.".format(problem))
+            self.tasks.remove(problem)
+            self.state[problem] = 'error'
+        except Exception as e:
+            logging.warning("Prefetching problem {} failed: {}".format(
+                problem, e))
+            self.state[problem] = 'error'
+        else:
+            self.state[problem] = 'warm'
+            self.syncTime[problem] = time() - startTime
+
+    def warmth(self):
+        """Return the fraction of the prefetched problems which are warm."""
+        if not self.state:
+            return 1.0
+        warm = sum(1 for state in list(self.state.values())
+                   if state == 'warm')
+        return float(warm) / len(self.state)
+
+    def run(self):
+        pool = ThreadPool(NODE['PREFETCH']['CONCURRENCY'])
+        while True:
+            problems = self.problems()
+            for problem in problems:
+                self.state.setdefault(problem, 'cold')
+            # Forget the problems which are no longer active
+            for problem in list(self.state):
+                if problem not in problems:
+                    del self.state[problem]
+                    self.syncTime.pop(problem, None)
+
+            pool.map(self.prefetch, problems)
+            logging.info(
+                "Prefetched {} problems, {:.0%} warm.".format(
+                    len(problems), self.warmth())
+            )
+            sleep(NODE['PREFETCH']['INTERVAL'])
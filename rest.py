@@ -2,14 +2,20 @@
 #-*- coding: utf8 -*-
 
 from settings import SUPERVISOR, NODE
+from utils import extract_archive, archive_version, ChunkReader
+from metrics import BYTES_TRANSFERRED
 
-from six.moves.http_client import FORBIDDEN, NOT_FOUND, OK
-from sys import exit
-from requests import ConnectionError
+from six.moves.http_client import FORBIDDEN, NOT_FOUND, NOT_MODIFIED, OK, \
+    PARTIAL_CONTENT
+from email.utils import formatdate
+from requests import ConnectionError, Timeout
+from requests.adapters import HTTPAdapter
 
 import logging
 import os
+import shutil
 import requests
+import threading
 import json
 
 
@@ -29,50 +35,87 @@ class UnknownErrorException(Exception):
     pass
 
 
+class ConnectionFailedException(Exception):
+    """Raised when the Supervisor could not be reached
+    or did not answer in time."""
+    pass
+
+
 class RESTConnection(object):
     """Class gathering all the REST queries and requests."""
 
+    _session = None
+    _sessionLock = threading.Lock()
+
     @classmethod
-    def __get(cls, url):
-        """Perform a GET request on the given URL."""
-        try:
-            return requests.get(
-                SUPERVISOR['HOST'] + url + '?format=json',
-                verify=True,
-                headers={'X-token': NODE['TOKEN']}
-            )
-        except ConnectionError as e:
-            logging.critical("Connection failed: {}".format(e))
-            exit(1)
+    def session(cls):
+        """Return the session shared by all the threads of the Node. It keeps
+        the connections to the Supervisor alive in a connection pool."""
+        with cls._sessionLock:
+            if cls._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=SUPERVISOR['POOL_CONNECTIONS'],
+                    pool_maxsize=SUPERVISOR['POOL_SIZE'],
+                    max_retries=SUPERVISOR['RETRIES'],
+                    pool_block=True
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update({
+                    'X-token': NODE['TOKEN'],
+                    'Accept-Encoding': 'gzip, deflate',
+                })
+                session.verify = True
+                cls._session = session
+            return cls._session
 
     @classmethod
-    def __put(cls, url, *args, **kwargs):
-        """Perform a POST request on the given URL."""
-        headers = {'X-token': NODE['TOKEN']}
-        headers.update(kwargs.get('headers', {}))
-        del kwargs['headers']
+    def __request(cls, method, url, params=None, timeout=0, **kwargs):
+        """Perform a request with the shared session. The timeout
+        is extended with the given number of seconds."""
+        query = {'format': 'json'}
+        query.update(params or {})
         try:
-            return requests.put(
-                SUPERVISOR['HOST'] + url + '?format=json',
-                verify=True,
-                headers=headers,
-                *args, **kwargs
+            return cls.session().request(
+                method,
+                SUPERVISOR['HOST'] + url,
+                params=query,
+                timeout=(SUPERVISOR['CONNECT_TIMEOUT'],
+                         SUPERVISOR['READ_TIMEOUT'] + timeout),
+                **kwargs
             )
+        except (ConnectionError, Timeout) as e:
+            logging.error("Connection failed: {}".format(e))
+            raise ConnectionFailedException(e)
 
-        except ConnectionError as e:
-            logging.critical("Connection failed: {}".format(e))
-            exit(1)
+    @classmethod
+    def __get(cls, url, params=None, **kwargs):
+        """Perform a GET request on the given URL."""
+        return cls.__request('GET', url, params, **kwargs)
 
     @classmethod
-    def get_submission(cls):
-        """Get a new submission for judging."""
+    def __put(cls, url, *args, **kwargs):
+        """Perform a PUT request on the given URL."""
+        return cls.__request('PUT', url, *args, **kwargs)
+
+    @classmethod
+    def get_submission(cls, wait=None):
+        """Get a new submission for judging. If wait is given the Supervisor
+        may hold the request for that many seconds until a submission
+        arrives."""
 
         # Prepare the URL
         url = 'submission/for_judging/'
 
-        response = cls.__get(url)
+        response = cls.__get(
+            url,
+            {'wait': wait} if wait else None,
+            timeout=wait or 0
+        )
 
         if response.status_code == OK:
+            BYTES_TRANSFERRED.inc(len(response.content), direction='download')
             # If everything is okay then parse the data and return it
             try:
                 data = json.loads(response.text)
@@ -116,6 +159,7 @@ class RESTConnection(object):
             data=data,
             headers={'Content-Type': 'application/json'}
         )
+        BYTES_TRANSFERRED.inc(len(data), direction='upload')
 
         if response.status_code == OK and not submission['error']:
             logging.info("The results have been sent.")
@@ -130,10 +174,11 @@ class RESTConnection(object):
             raise UnknownErrorException()
 
     @classmethod
-    def get_test_timestamps(cls, problem):
-        """Get the timestamps for the tests for the problem with a given id."""
+    def get_active_problems(cls):
+        """Get the ids of the problems which are used in active
+        or upcoming contests."""
 
-        url = 'problem/{}/test_timestamps'.format(problem)
+        url = 'problem/active/'
 
         response = cls.__get(url)
 
@@ -142,19 +187,16 @@ class RESTConnection(object):
                 data = json.loads(response.text)
             except Exception as e:
                 logging.error(
-                    "Error while parsing response: {}\n{}.".format(data, e)
+                    "Error while parsing response: {}\n{}.".format(
+                        response.text, e)
                 )
                 raise
 
-            logging.info(
-                "Recived test timestamps for problem {}.".format(problem)
-            )
-            return data
+            logging.info("Recived {} active problems.".format(len(data)))
+            return [str(problem) for problem in data]
 
         elif response.status_code == NOT_FOUND:
-            logging.info(
-                "No test timestamps for problem {}.".format(problem)
-            )
+            logging.info("No active problems.")
             raise NotFoundException()
         elif response.status_code == FORBIDDEN:
             logging.warning("Node unauthorized.")
@@ -165,40 +207,133 @@ class RESTConnection(object):
             raise UnknownErrorException()
 
     @classmethod
-    def get_tests(cls, problem, testType, path):
-        """Get the tests for the problem with a given id as a file path."""
-
-        # There are only 3 types of test files
-        if testType not in ('input', 'output', 'config'):
+    def get_tests(cls, problem, testType, path, storePath=None,
+                  throttle=None):
+        """Get the tests for the problem with a given id as a file path.
+        If the file already exists the request is conditional and the file
+        is kept if the Supervisor reports it as not modified. If storePath
+        is given the archive is extracted while it is downloaded into its
+        subdirectory named by utils.archive_version, earlier versions are
+        left in place for the tests still using them.
+        The throttle is called with the size of every downloaded chunk.
+        Return whether the file has been downloaded."""
+
+        # There are only 4 types of test files
+        if testType not in ('input', 'output', 'config', 'checker'):
             raise TypeError("Type not recognized: {}.".format(testType))
 
         url = 'problem/{}/test_{}/'.format(problem, testType)
 
-        response = cls.__get(url)
+        headers = {}
+        if os.path.exists(path):
+            validators = cls.__read_validators(path)
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            headers['If-Modified-Since'] = validators.get('lastModified') or \
+                formatdate(os.path.getmtime(path), usegmt=True)
 
-        if response.status_code == OK:
-            cls.__write_to_file(response, path)
-        elif response.status_code == NOT_FOUND:
-            logging.info("No tests for problem {}.".format(problem))
-            raise NotFoundException()
-        elif response.status_code == FORBIDDEN:
-            logging.warning("Node unauthorized.")
-            raise UnauthorizedException()
-        else:
-            logging.error("Unknown error status code: {}".format(
-                response.status_code))
-            raise UnknownErrorException()
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by a concurrent download
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
 
-    @classmethod
-    def __write_to_file(cls, response, path):
-        """Writes the response body to a file given by the path."""
+        # Resume an interrupted download of the same archive version
+        partPath = path + '.part'
+        partValidators = cls.__read_validators(partPath)
+        if os.path.exists(partPath) and partValidators.get('etag'):
+            headers['Range'] = 'bytes={}-'.format(os.path.getsize(partPath))
+            headers['If-Range'] = partValidators['etag']
 
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
+        response = cls.__get(url, stream=True, headers=headers)
 
-        if os.path.exists(path):
-            os.remove(path)
+        try:
+            if response.status_code in (OK, PARTIAL_CONTENT):
+                resume = response.status_code == PARTIAL_CONTENT
+                if resume:
+                    logging.info("Resuming download of {}.".format(path))
+                else:
+                    cls.__write_validators(partPath, {
+                        'etag': response.headers.get('ETag'),
+                        'lastModified': response.headers.get('Last-Modified'),
+                    })
+                tmpPath = cls.__download(response, partPath, storePath,
+                                         resume, throttle)
+
+                # The complete archive replaces the old one at once
+                os.rename(partPath + '.validators', path + '.validators')
+                os.rename(partPath, path)
+                if tmpPath is not None:
+                    versionPath = os.path.join(storePath,
+                                               archive_version(path))
+                    if os.path.exists(versionPath):
+                        shutil.rmtree(tmpPath, ignore_errors=True)
+                    else:
+                        os.rename(tmpPath, versionPath)
+                return True
+            elif response.status_code == NOT_MODIFIED:
+                logging.info("Tests {} for problem {} not modified.".format(
+                    testType, problem))
+                return False
+            elif response.status_code == NOT_FOUND:
+                logging.info("No tests for problem {}.".format(problem))
+                raise NotFoundException()
+            elif response.status_code == FORBIDDEN:
+                logging.warning("Node unauthorized.")
+                raise UnauthorizedException()
+            else:
+                logging.error("Unknown error status code: {}".format(
+                    response.status_code))
+                raise UnknownErrorException()
+        finally:
+            # Give the connection back to the pool
+            response.close()
+
+    @staticmethod
+    def __read_validators(path):
+        """Read the ETag and Last-Modified saved for the file."""
+        try:
+            with open(path + '.validators', 'r') as validatorsFile:
+                return json.load(validatorsFile)
+        except (IOError, ValueError):
+            return {}
 
-        with open(path, 'wb') as output:
-            for chunk in response.iter_content(1024):
-                output.write(chunk)
+    @staticmethod
+    def __write_validators(path, validators):
+        with open(path + '.validators', 'w') as validatorsFile:
+            json.dump(validators, validatorsFile)
+
+    @classmethod
+    def __download(cls, response, path, storePath, resume, throttle=None):
+        """Write the response body to the file given by the path, appending
+        to it if resume is set, and extract it into a temporary directory
+        of the store at the same time. Return the temporary directory."""
+
+        chunkSize = SUPERVISOR['DOWNLOAD_CHUNK_SIZE']
+        with open(path, 'ab' if resume else 'wb') as output:
+
+            def chunks():
+                if resume:
+                    # The downloaded part has to be extracted too
+                    with open(path, 'rb') as part:
+                        for chunk in iter(lambda: part.read(chunkSize), b''):
+                            yield chunk
+                for chunk in response.iter_content(chunkSize):
+                    output.write(chunk)
+                    BYTES_TRANSFERRED.inc(len(chunk), direction='download')
+                    if throttle is not None:
+                        throttle(len(chunk))
+                    yield chunk
+
+            stream = chunks()
+            tmpPath = None
+            if storePath is not None:
+                tmpPath = os.path.join(storePath, '.extracting')
+                shutil.rmtree(tmpPath, ignore_errors=True)
+                os.makedirs(tmpPath)
+                extract_archive(ChunkReader(stream), tmpPath)
+            # Write whatever follows the last member of the archive
+            for chunk in stream:
+                pass
+        return tmpPath
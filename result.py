@@ -3,15 +3,50 @@
 
 
 class Result(object):
-    """Result for one test. Contains the return code,
-    mark and execution time"""
+    """Result for one test. Contains the return code, mark, execution
+    (user CPU) time, system CPU time, wall time and peak memory in kb.
+    The startup time is the part of the execution time the language runtime
+    needs to start, it is included in the time. Skipped tests have not been
+    run because of an earlier failure, tests of programs which could not be
+    compiled are not run at all."""
 
-    def __init__(self, returncode, mark, time):
+    def __init__(self, returncode, mark, time, systemTime=0, wallTime=0,
+                 memory=0, skipped=False, startupTime=0,
+                 compilationError=False):
         self.returncode = returncode
         self.mark = mark
         self.time = time
+        self.systemTime = systemTime
+        self.wallTime = wallTime
+        self.memory = memory
+        self.skipped = skipped
+        self.startupTime = startupTime
+        self.compilationError = compilationError
 
     def __repr__(self):
-        return "Result(returncode={}, mark={}, time={})".format(
-            self.returncode, self.mark, self.time
+        return "Result(returncode={}, mark={}, time={}, systemTime={}, " \
+            "wallTime={}, memory={}, skipped={}, startupTime={}, " \
+            "compilationError={})".format(
+                self.returncode, self.mark, self.time, self.systemTime,
+                self.wallTime, self.memory, self.skipped, self.startupTime,
+                self.compilationError
+            )
+
+
+class Compilation(object):
+    """Outcome of compiling a source. Contains the return code of
+    the compiler, its output and the wall time it took."""
+
+    def __init__(self, returncode, log, time=0):
+        self.returncode = returncode
+        self.log = log
+        self.time = time
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return "Compilation(returncode={}, time={}, log={!r})".format(
+            self.returncode, self.time, self.log
         )
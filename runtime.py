@@ -0,0 +1,84 @@
+#-*- coding: utf8 -*-
+from settings import LANGUAGES, NODE
+from subprocess import Popen, PIPE, STDOUT
+import os
+import threading
+import logging
+
+_startupTimes = {}
+_startupLock = threading.Lock()
+# Languages whose prepareCommand succeeded
+_prepared = set()
+
+# Number of runs of the startup command, the fastest one is taken
+STARTUP_RUNS = 3
+
+
+def format_command(command, language=None, **kwargs):
+    """Fill in the placeholders of a command of the language
+    from LANGUAGES."""
+    preparedOptions = ''
+    if language in _prepared:
+        preparedOptions = LANGUAGES[language].get('preparedOptions', '') \
+            .format(runtimeDir=NODE['RUNTIME_PATH'])
+    return command.format(runtimeDir=NODE['RUNTIME_PATH'],
+                          preparedOptions=preparedOptions, **kwargs)
+
+
+def prepare():
+    """Run the prepareCommand of every language, e.g. to build the class
+    data sharing archive of Java. Failures are only logged, the runtimes
+    work without the prepared files and their preparedOptions, just start
+    slower."""
+    if not os.path.exists(NODE['RUNTIME_PATH']):
+        os.makedirs(NODE['RUNTIME_PATH'])
+
+    for language, settings in LANGUAGES.items():
+        command = settings.get('prepareCommand')
+        if command is None:
+            continue
+        logging.info("Preparing the {} runtime.".format(language))
+        try:
+            process = Popen(format_command(command), shell=True,
+                            stdout=PIPE, stderr=STDOUT)
+            output = process.communicate()[0]
+        except OSError as e:
+            logging.warning("Preparing the {} runtime failed: {}".format(
+                language, e))
+            continue
+        if process.returncode != 0:
+            logging.warning("Preparing the {} runtime failed: {}".format(
+                language, output.decode('utf-8', 'replace')))
+            continue
+        _prepared.add(language)
+
+
+def startup_time(language, sandbox):
+    """Return the user CPU time the runtime of the language needs to start,
+    measured in the sandbox the first time it is needed. Languages without
+    a startupCommand are assumed to start immediately."""
+    command = LANGUAGES[language].get('startupCommand')
+    if command is None:
+        return 0
+
+    with _startupLock:
+        if language not in _startupTimes:
+            times = []
+            for _ in range(STARTUP_RUNS):
+                output, returncode, usage = sandbox.execute(
+                    format_command(command, language,
+                                   sandboxHome=sandbox.homeDir),
+                    b'',
+                    timeLimit=NODE['SANDBOX']['COMPILER_TIMELIMIT']
+                )
+                if returncode != 0:
+                    logging.warning(
+                        "Startup time of {} cannot be measured.".format(
+                            language))
+                    times = [0]
+                    break
+                times.append(usage.userTime)
+            _startupTimes[language] = min(times)
+            logging.info("Startup time of {} is {:.3f}s.".format(
+                language, _startupTimes[language]))
+        return _startupTimes[language]
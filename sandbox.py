@@ -3,8 +3,16 @@ from settings import NODE, LANGUAGES
 from subprocess import PIPE
 from subprocess import Popen
 from six import itervalues
+from metrics import SANDBOX_SPAWN
+from time import time
+from math import ceil
 import os
+import signal
+import shutil
+import fcntl
+import tempfile
 import codecs
+import threading
 import logging
 
 
@@ -13,24 +21,268 @@ class UnsupportedSandboxException(Exception):
     pass
 
 
+class Usage(object):
+    """Resources used by a process run in the sandbox. Times are given
+    in seconds and the peak resident memory in kb."""
+
+    def __init__(self, userTime=0, systemTime=0, wallTime=0, memory=0):
+        self.userTime = userTime
+        self.systemTime = systemTime
+        self.wallTime = wallTime
+        self.memory = memory
+
+    @staticmethod
+    def from_rusage(rusage, wallTime):
+        return Usage(rusage.ru_utime, rusage.ru_stime, wallTime,
+                     rusage.ru_maxrss)
+
+    @staticmethod
+    def from_report(report, wallTime):
+        """Parse the report written by MEASURE_HELPER,
+        return the wait status and the Usage."""
+        status, userTime, systemTime, memory = report.split()
+        return int(status), Usage(float(userTime), float(systemTime),
+                                  wallTime, int(memory))
+
+    def __repr__(self):
+        return "Usage(userTime={}, systemTime={}, wallTime={}, " \
+            "memory={})".format(self.userTime, self.systemTime,
+                                self.wallTime, self.memory)
+
+
+# Runs the program in the sandbox with the given memory (kb) and CPU time
+# (s) limits, each of them may be left empty, waits for it and reports its
+# resource usage at the end of stderr after USAGE_MARKER. Only the program
+# and its waited for children are measured, not the sandbox itself.
+# The program is forked by a shell rather than by the interpreter, whose
+# memory would be counted in its peak. It waits until the shell has exited
+# and becomes a child of the helper, which reaps it.
+MEASURE_HELPER = """
+import os, sys, resource, ctypes
+limits, argv = sys.argv[1].split(","), sys.argv[2:]
+# PR_SET_CHILD_SUBREAPER, orphaned descendants become children of the helper
+ctypes.CDLL(None).prctl(36, 1)
+pidRead, pidWrite = os.pipe()
+gateRead, gateWrite = os.pipe()
+pid = os.fork()
+if pid == 0:
+    try:
+        os.dup2(pidWrite, 3)
+        os.dup2(gateRead, 4)
+        # Background jobs get /dev/null as stdin, the input is kept in 5
+        os.dup2(0, 5)
+        if limits[0]:
+            memory = int(limits[0]) * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        if limits[1]:
+            cpu = int(limits[1])
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+        os.execvp("sh", ["sh", "-c", "{ read x <&4; "
+                         "exec \\"$@\\" <&5 3>&- 4<&- 5<&-; } & echo $! >&3",
+                         "sh"] + argv)
+    finally:
+        os._exit(127)
+os.close(pidWrite)
+os.close(gateRead)
+pid, status, usage = os.wait4(pid, 0)
+pid = os.read(pidRead, 64)
+os.close(gateWrite)
+if pid:
+    pid, status, usage = os.wait4(int(pid), 0)
+os.write(2, ("\\0usage %d %r %r %d" % (status, usage.ru_utime,
+             usage.ru_stime, usage.ru_maxrss)).encode("ascii"))
+"""
+USAGE_MARKER = b'\0usage '
+
+
+class WorkspacePool(object):
+    """Pool of sandbox directories kept on a RAM-backed file system.
+    Spare workspaces are created and used ones are deleted by a background
+    thread, so acquiring and releasing a workspace only renames it.
+    Every process keeps its workspaces in its own directory under the root,
+    locked while the process runs, so several Nodes may share the root."""
+
+    def __init__(self, root, size):
+        self.root = root
+        # Directory of this process, created when the pool is started
+        self.path = None
+        self.size = size
+        self._spare = []
+        self._trash = []
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._thread = None
+
+    def _name(self, prefix):
+        self._counter += 1
+        return os.path.join(self.path, '{}{}'.format(prefix, self._counter))
+
+    def _create(self):
+        path = self._name('workspace-')
+        os.mkdir(path)
+        os.mkdir(os.path.join(path, 'home'))
+        os.mkdir(os.path.join(path, 'tmp'))
+        return path
+
+    def _start(self):
+        """Clean the leftovers of processes which are no longer running,
+        create the directory of this process and start the cleaner."""
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self._remove_stale()
+        fd, lockPath = tempfile.mkstemp(prefix='node-', suffix='.lock',
+                                        dir=self.root)
+        # The lock is held until the process exits
+        self._lockFile = os.fdopen(fd, 'w')
+        fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+        self.path = lockPath[:-len('.lock')]
+        os.mkdir(self.path)
+        self._thread = threading.Thread(target=self._clean,
+                                        name='WorkspaceCleaner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _remove_stale(self):
+        """Delete the directories whose lock is not held by any process."""
+        for name in os.listdir(self.root):
+            if not name.endswith('.lock'):
+                continue
+            lockPath = os.path.join(self.root, name)
+            with open(lockPath, 'a') as lockFile:
+                try:
+                    fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # Used by a running process
+                    continue
+                shutil.rmtree(lockPath[:-len('.lock')], ignore_errors=True)
+                os.remove(lockPath)
+
+    def acquire(self):
+        """Return the home and tmp directories of an empty workspace."""
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            path = self._spare.pop() if self._spare else self._create()
+            self._work.notify()
+        return os.path.join(path, 'home'), os.path.join(path, 'tmp')
+
+    def release(self, homeDir):
+        """Give back the workspace with the given home directory."""
+        path = os.path.dirname(homeDir)
+        with self._lock:
+            trash = self._name('.trash-')
+            os.rename(path, trash)
+            self._trash.append(trash)
+            self._work.notify()
+
+    def _clean(self):
+        """Delete used workspaces and prepare the spare ones."""
+        while True:
+            with self._lock:
+                while not self._trash and len(self._spare) >= self.size:
+                    self._work.wait()
+                trash = self._trash.pop() if self._trash else None
+                if trash is None:
+                    self._spare.append(self._create())
+            if trash is not None:
+                shutil.rmtree(trash, ignore_errors=True)
+
+
 class Sandbox(object):
     """Abstract sandbox class."""
 
+    # Shared pool of RAM-backed workspaces, None if not configured
+    workspaces = None
+
+    def __init__(self, name=None):
+        """Use the configured sandbox directories, suffixed with the given
+        name so that concurrent sandboxes do not share them."""
+        self.name = name
+        self.homeDir = NODE['SANDBOX']['HOME_DIR']
+        self.tmpDir = NODE['SANDBOX']['TMP_DIR']
+        # Sandbox whose files are copied into this one on creation
+        self.template = None
+        if name is not None:
+            self.homeDir = '{}_{}'.format(self.homeDir, name)
+            self.tmpDir = '{}_{}'.format(self.tmpDir, name)
+
     def execute(self, command, input, timeout):
-        """Execute the given command in the sandbox environment."""
+        """Execute the given command in the sandbox environment and return
+        the stdout and stderr, the return code and the Usage of resources.
+        Instead of the input data an inputFile path may be given as the stdin.
+        If an outputChecker is given the stdout is fed to it while the
+        program runs and the program is killed once the checker rejects it."""
         raise NotImplementedError()
 
+    @staticmethod
+    def _communicate(process, input, outputChecker=None):
+        """Like Popen.communicate but reap the process with wait4 and
+        return its resource usage too. If the outputChecker is given
+        the stdout is streamed to it and an empty stdout is returned."""
+
+        def write():
+            try:
+                if input:
+                    process.stdin.write(input)
+                process.stdin.close()
+            except (IOError, OSError):
+                # The program does not read its whole input
+                pass
+
+        err = []
+        threads = [threading.Thread(
+            target=lambda: err.append(process.stderr.read()))]
+        if process.stdin is not None:
+            threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        out = []
+        fd = process.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            if outputChecker is None:
+                out.append(chunk)
+            elif not outputChecker.feed(chunk):
+                outputChecker.aborted = True
+                logging.info("Wrong output, stopping the program.")
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                # Drain what is left so that the pipe gets closed
+                while os.read(fd, 65536):
+                    pass
+                break
+
+        # The usage of the process includes all its waited for children
+        pid, status, rusage = os.wait4(process.pid, 0)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+
+        for thread in threads:
+            thread.join()
+        process.stdout.close()
+        process.stderr.close()
+        return (b''.join(out), err[0] if err else b''), rusage
+
     def test_sandbox(self):
         """Test if the system can run this type of sandbox environment."""
         raise NotImplementedError()
 
     @staticmethod
-    def new():
+    def new(name=None):
         """Create a new Sandbox instance according to the configuration."""
         if NODE['SANDBOX']['BACKEND'] == 'selinux':
-            return SELinuxSandbox()
+            return SELinuxSandbox(name)
         else:
-            return Sandbox()
+            return Sandbox(name)
 
     def _delete_dir(self, dirName):
         """Delete a given directory tree."""
@@ -46,43 +298,73 @@ class Sandbox(object):
 
     def _create_sandbox(self):
         """Create directories for sandbox purposes (home_dir and tmp_dir).
-        Folder names are specified on settings file."""
+        Folder names are specified on settings file, unless they are taken
+        from the workspace pool."""
 
-        # Delete just to make sure
-        self._delete_sandbox()
-        try:
-            os.mkdir(NODE['SANDBOX']['HOME_DIR'])
-            os.mkdir(NODE['SANDBOX']['TMP_DIR'])
-        except OSError:
-            logging.error("Error while creating sandbox directory.")
-            raise
+        if self.workspaces is not None:
+            self.homeDir, self.tmpDir = self.workspaces.acquire()
+        else:
+            # Delete just to make sure
+            self._delete_sandbox()
+            try:
+                os.mkdir(self.homeDir)
+                os.mkdir(self.tmpDir)
+            except OSError:
+                logging.error("Error while creating sandbox directory.")
+                raise
+
+        if self.template is not None:
+            self._copy_files(self.template.homeDir)
+
+    def _copy_files(self, dirName):
+        """Copy the contents of a given directory into the sandbox home."""
+        for name in os.listdir(dirName):
+            source = os.path.join(dirName, name)
+            destination = os.path.join(self.homeDir, name)
+            if os.path.isdir(source):
+                shutil.copytree(source, destination)
+            else:
+                shutil.copy2(source, destination)
+
+    def clone(self, name):
+        """Return a new sandbox which will hold a working copy
+        of the files of this sandbox once entered."""
+        if self.name is not None:
+            name = '{}_{}'.format(self.name, name)
+        sandbox = Sandbox.new(name)
+        sandbox.template = self
+        return sandbox
 
     def file(self, name):
         """Return a file object created inside the sandbox."""
-        path = os.path.join(NODE['SANDBOX']['HOME_DIR'], name)
+        path = os.path.join(self.homeDir, name)
         return codecs.open(path, 'w', 'utf-8')
 
     def _delete_sandbox(self):
         """Delete the sandbox dirs."""
-        self._delete_dir(NODE['SANDBOX']['HOME_DIR'])
-        self._delete_dir(NODE['SANDBOX']['TMP_DIR'])
+        self._delete_dir(self.homeDir)
+        self._delete_dir(self.tmpDir)
 
     def __enter__(self):
         self._create_sandbox()
         return self
 
     def __exit__(self, *args, **kwargs):
-        self._delete_sandbox()
+        if self.workspaces is not None:
+            self.workspaces.release(self.homeDir)
+        else:
+            self._delete_sandbox()
 
 
 class SELinuxSandbox(Sandbox):
     """SELinux-based sandbox implementation."""
 
-    def __init__(self):
-        self.sandboxCmd = 'sandbox -t sandbox_t' +\
+    @property
+    def sandboxCmd(self):
+        return 'sandbox -t sandbox_t' +\
             ' -M -H {sandboxHome} -T {sandboxTmp}'.format(
-            sandboxHome=NODE['SANDBOX']['HOME_DIR'],
-            sandboxTmp=NODE['SANDBOX']['TMP_DIR'])
+            sandboxHome=self.homeDir,
+            sandboxTmp=self.tmpDir)
 
     def test_sandbox(self):
         logging.info('Performing sandbox test...')
@@ -90,7 +372,7 @@ class SELinuxSandbox(Sandbox):
             command = 'which ' + lang['compiler']
             c = self.execute(
                 command,
-                input="",
+                input=b"",
                 memoryLimit=2000000,
                 timeLimit=5
             )
@@ -102,37 +384,59 @@ class SELinuxSandbox(Sandbox):
         memoryLimit = kwargs.get('memoryLimit')
         timeLimit = kwargs.get('timeLimit')
 
-        if memoryLimit:
-            ulimitCmd = 'ulimit -v {memoryLimit} -t {timeLimit};'.format(
-                memoryLimit=memoryLimit,
-                timeLimit=timeLimit
-            )
-        else:
-            ulimitCmd = ''
-
-        timeCmd = '/usr/bin/time -o time.log -f %U'
-        cmd = '{ulimit}{sandbox} {time} {command}'.format(
-            ulimit=ulimitCmd,
-            sandbox=self.sandboxCmd,
-            time=timeCmd,
-            command=command
+        limits = '{},{}'.format(
+            memoryLimit or '',
+            int(ceil(timeLimit)) if timeLimit else ''
         )
-        logging.info('Performing {}'.format(cmd))
 
-        # Run the process
-        process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True)
+        # The program is limited and measured by the helper inside the
+        # sandbox, the shell is replaced by the sandbox
+        cmd = "exec {sandbox} {python} -S -c '{helper}' {limits} {command}" \
+            .format(
+                sandbox=self.sandboxCmd,
+                python=NODE['SANDBOX']['PYTHON'],
+                helper=MEASURE_HELPER,
+                limits=limits,
+                command=command
+            )
+        logging.info('Performing {}'.format(command))
 
-        output = map(lambda s: s.decode('utf-8'), process.communicate(input))
+        # Run the process, the input file is attached directly as stdin.
+        # The process gets its own group so it can be killed with children.
+        inputFile = kwargs.get('inputFile')
+        startTime = time()
+        if inputFile:
+            with open(inputFile, 'rb') as stdin:
+                process = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE,
+                                shell=True, start_new_session=True)
+        else:
+            process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                            shell=True, start_new_session=True)
+        SANDBOX_SPAWN.observe(time() - startTime)
+
+        (out, err), rusage = self._communicate(process, input,
+                                               kwargs.get('outputChecker'))
+        wallTime = time() - startTime
 
-        # Get the time from the logging
-        time = 0
-        with open(os.path.join(NODE['SANDBOX']['HOME_DIR'], 'time.log'),
-                  'r') as timeLogFile:
-            lines = timeLogFile.read().split('\n')
-            # File can contain 'Command exited with non-zero exit code'...
-            if len(lines) > 2:
-                time = float(lines[1])
+        err, marker, report = err.rpartition(USAGE_MARKER)
+        if marker:
+            status, usage = Usage.from_report(report, wallTime)
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
             else:
-                time = float(lines[0])
+                returncode = os.WEXITSTATUS(status)
+        else:
+            # The helper has been killed too, e.g. on a wrong answer,
+            # only the usage of the whole sandbox is known
+            err = report
+            returncode = process.returncode
+            usage = Usage.from_rusage(rusage, wallTime)
+
+        return ((out, err), returncode, usage)
+
 
-        return (output, process.returncode, time)
+if NODE['SANDBOX']['WORKSPACE_ROOT'] is not None:
+    Sandbox.workspaces = WorkspacePool(
+        NODE['SANDBOX']['WORKSPACE_ROOT'],
+        NODE['SANDBOX']['WORKSPACE_POOL_SIZE']
+    )
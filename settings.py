@@ -17,7 +17,13 @@ def get_java_filename(sourceCode):
     return "bad.java"
 
 
-# List of languages supported by the Node
+# List of languages supported by the Node. Commands may use {runtimeDir},
+# the folder NODE['RUNTIME_PATH'] shared by all the submissions:
+# prepareCommand is run once when the Node starts, e.g. to build a class data
+# sharing archive, and startupCommand starts the runtime without doing
+# anything to measure the startup time reported in the results. Commands
+# may also use {preparedOptions}, the preparedOptions of the language if its
+# prepareCommand succeeded and nothing otherwise.
 LANGUAGES = {
     'C': {
         'compiler': 'gcc',
@@ -39,14 +45,34 @@ LANGUAGES = {
     },
     'Python': {
         'compiler': 'python',
-        'compilerOptions': '-m py_compile',
-        'runCommand': 'python {fileName}.{fileExtension}',
+        # Byte-compiled to prog.pyc which is run without compiling again,
+        # the site module is still imported for exit() and site-packages
+        'compilerOptions': '-c "import sys, py_compile; py_compile.compile('
+                           'sys.argv[1], sys.argv[1] + \'c\', doraise=True)"',
+        'runCommand': 'python -E {fileName}.pyc',
+        'startupCommand': 'python -E -c pass',
         'sourceFilename': 'prog.py'
     },
+    # Uncomment to judge with PyPy too
+    # 'PyPy': {
+    #     'compiler': 'pypy3',
+    #     'compilerOptions': '-c "import sys, py_compile; py_compile.compile('
+    #                        'sys.argv[1], sys.argv[1] + \'c\', doraise=True)"',
+    #     'runCommand': 'pypy3 -E {fileName}.pyc',
+    #     'startupCommand': 'pypy3 -E -c pass',
+    #     'sourceFilename': 'prog.py'
+    # },
     'Java': {
         'compiler': 'javac',
         'compilerOptions': "",
-        'runCommand': 'java  -Xmx2000k {fileName}',
+        # The JDK classes are mapped from the class data sharing archive
+        # built once, -XX:SharedArchiveFile requires JDK 10 or newer
+        'preparedOptions': '-Xshare:auto '
+                           '-XX:SharedArchiveFile={runtimeDir}/java.jsa',
+        'runCommand': 'java {preparedOptions} -Xmx2000k {fileName}',
+        'prepareCommand': 'java -Xshare:dump '
+                          '-XX:SharedArchiveFile={runtimeDir}/java.jsa',
+        'startupCommand': 'java {preparedOptions} -Xmx2000k -version',
         'sourceFilename': get_java_filename
     }
 }
@@ -55,12 +81,42 @@ LANGUAGES = {
 NODE = {
     # The Node's secret key checked in the Supervisor
     'TOKEN': 'ABCD',
-    # The minimal time in seconds between Node's query to the Supervisor
+    # The time in seconds between Node's queries to the Supervisor
+    # while the Node is unauthorized
     'QUERY_TIME': 5,
+    # Jittered exponential backoff in seconds used between queries
+    # when there are no submissions to judge
+    'QUERY_BACKOFF': {
+        'BASE': 0.5,
+        'MAX': 30,
+    },
+    # Time in seconds the Supervisor may hold a submission request until
+    # a submission arrives, 0 disables long-polling
+    'LONG_POLL_TIME': 30,
+    # Time in seconds after which long-polling is tried again when
+    # the Supervisor answered a long-polled request without holding it
+    'LONG_POLL_RETRY': 600,
+    # Number of submissions judged concurrently, each in its own sandbox
+    'WORKERS': 1,
+    # Number of tests of a single submission executed concurrently,
+    # each one in a separate copy of the submission sandbox
+    'TEST_WORKERS': 1,
+    # Number of bytes the program output may exceed the reference output
+    # before the program is stopped
+    'OUTPUT_MARGIN': 1024 * 1024,
     # The max memory in kb the node provides
     'MAX_MEMORY': 1000000,
+    # Tests kept in memory between submissions
+    'TASK_CACHE': {
+        # The max size in bytes of the test data of all the cached tasks
+        'MAX_SIZE': 256 * 1024 * 1024,
+        # The least recently used tasks are evicted when the free memory
+        # in kb drops below this value
+        'MIN_FREE_MEMORY': 256 * 1024,
+    },
     # Can be 'file', 'http' or 'S3'
-    # 'file' - get all the tests from the local file system
+    # 'file' - get all the tests from the local file system, from the in, ref
+    # and conf folders of TEST_PATH (see task.FileTask)
     # Warning! The tests won't be downloaded if they're not found
     # 'http' - like file but also download the tests from the Supervisor if not
     # found in the local file system
@@ -69,16 +125,80 @@ NODE = {
     'TEST_BACKEND': 'rest',
     # Absolute path to the folder containing the tests
     'TEST_PATH': p('tests'),
+    # Absolute path to the folder with the files prepared for the language
+    # runtimes, see LANGUAGES
+    'RUNTIME_PATH': p('cache', 'runtime'),
+    # Max number of characters of the compiler output sent as the log
+    'COMPILATION_LOG_LIMIT': 64 * 1024,
+    # Cache of compiled programs shared by resubmissions and rejudges
+    'COMPILATION_CACHE': {
+        # Absolute path to the cache folder, None disables the cache
+        'PATH': p('cache', 'compilation'),
+        # The max size of the cache in bytes
+        'MAX_SIZE': 512 * 1024 * 1024,
+    },
+    # Max number of judged submissions whose results are reused
+    # for identical submissions, 0 disables the cache
+    'RESULT_CACHE_SIZE': 1000,
+    # Time in seconds during which tests are used without checking
+    # with the Supervisor if they are up-to-date
+    'TEST_CHECK_TTL': 30,
+    # Background download of tests of active and recently used problems
+    'PREFETCH': {
+        'ENABLED': True,
+        # Time in seconds between prefetching rounds
+        'INTERVAL': 60,
+        # Number of problems prefetched at the same time
+        'CONCURRENCY': 2,
+        # Download limit in bytes per second, None for no limit
+        'BANDWIDTH': 10 * 1024 * 1024,
+    },
+    # Journal of results waiting to be sent to the Supervisor
+    'OUTBOX': {
+        # Absolute path to the outbox folder
+        'PATH': p('outbox'),
+        # Number of failed attempts after which the results are moved
+        # to the failed subfolder
+        'MAX_ATTEMPTS': 100,
+        # Jittered exponential backoff in seconds between failed attempts
+        'BACKOFF': {
+            'BASE': 1,
+            'MAX': 60,
+        },
+    },
+    # Prometheus metrics served on http://HOST:PORT/metrics
+    'METRICS': {
+        'ENABLED': True,
+        'HOST': '127.0.0.1',
+        'PORT': 9462,
+        # Absolute path to the folder where the timeline of every judged
+        # submission is saved, None disables the traces
+        'TRACE_DIR': None,
+    },
     # Sandbox configuration
     'SANDBOX': {
         # Sandbox backend, only 'selinux' supported now
         'BACKEND': 'selinux',
         # Sandbox temporary directories used while sandboxing
-        # and deleted soon after
+        # and deleted soon after, every worker appends its number to them
         'HOME_DIR': './sandbox_home',
         'TMP_DIR': './sandbox_tmp',
+        # Folder on a RAM-backed file system (e.g. tmpfs) holding a pool
+        # of reusable sandbox directories used instead of HOME_DIR and
+        # TMP_DIR, None disables the pool. Every Node uses its own
+        # subfolder, so the folder may be shared
+        'WORKSPACE_ROOT': '/dev/shm/zebra-node',
+        # Number of empty workspaces prepared in advance
+        'WORKSPACE_POOL_SIZE': 4,
+        # Python interpreter available in the sandbox, it runs the helper
+        # which limits and measures the programs
+        'PYTHON': 'python',
         # Limit for compilation time in seconds
         'COMPILER_TIMELIMIT': 20,
+        # Limit for a single run of a problem checker in seconds
+        'CHECKER_TIMELIMIT': 10,
+        # Limit for the memory of a problem checker in kb
+        'CHECKER_MEMORYLIMIT': 1024 * 1024,
     }
 }
 
@@ -86,4 +206,15 @@ NODE = {
 SUPERVISOR = {
     # The address of the Supervisor REST webservice
     'HOST': 'http://localhost:8000/rest/',
+    # Timeouts in seconds for establishing a connection
+    # and waiting for the response
+    'CONNECT_TIMEOUT': 5,
+    'READ_TIMEOUT': 60,
+    # Number of connection retries before the request fails
+    'RETRIES': 3,
+    # Number of pooled connections kept alive for each host
+    'POOL_CONNECTIONS': 4,
+    'POOL_SIZE': 16,
+    # Size in bytes of the buffer used while downloading tests
+    'DOWNLOAD_CHUNK_SIZE': 1024 * 1024,
 }
@@ -1,19 +1,32 @@
 #! /usr/bin/env python
 #-*- coding: utf8 -*-
-from utils import iso_to_datetime, get_file_modification_date
-from test import Test
+from utils import get_free_memory, extract_archive, read_members, \
+    archive_version, natural_key
+from test import Test, FileTest
 from settings import NODE
-from rest import RESTConnection
+from rest import RESTConnection, NotFoundException
+from checker import Checker
+from metrics import measure, CACHE_REQUESTS
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from time import time
 import os
-import tarfile
+import shutil
+import threading
 import logging
 import json
+import weakref
 
 
 class Task(object):
     """Represents single task. It is defined by a problem id and
     manages tests for that problem."""
 
+    # Special judge used instead of comparing outputs, if the problem has one
+    checker = None
+    # Problem wide options, e.g. the comparator and its tolerance
+    config = {}
+
     def __init__(self, problem):
         """Load tests for the given problem id."""
         raise NotImplementedError()
@@ -27,6 +40,27 @@ class Task(object):
         """Checks if tests need realoading."""
         raise NotImplementedError()
 
+    @property
+    def size(self):
+        """Number of bytes of test data held in memory."""
+        raise NotImplementedError()
+
+    @property
+    def version(self):
+        """Hashable value which changes whenever the tests change,
+        None if the tests have not been loaded yet."""
+        return None
+
+    def warm(self, rateLimiter=None):
+        """Bring the tests up-to-date ahead of their use. Downloads
+        may be limited by the rate limiter."""
+        return self.tests
+
+    def sample_flags(self):
+        """Return whether each of the tests is a sample test, in the order
+        of the tests, or None if it is not known without the tests."""
+        return [test.isSampleTest for test in self.tests.values()]
+
     def _load_tests(self):
         """Loads the tests from the given backend."""
         raise NotImplementedError()
@@ -41,141 +75,534 @@ class Task(object):
             return RESTTask(problem)
 
 
+class TaskCache(object):
+    """Tasks kept in memory between submissions. When the test data
+    exceeds the size limit or the system runs low on memory the least
+    recently used tasks are evicted."""
+
+    def __init__(self, maxSize, minFreeMemory):
+        self.maxSize = maxSize
+        self.minFreeMemory = minFreeMemory
+        self._tasks = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __contains__(self, problem):
+        return problem in self._tasks
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def problems(self):
+        """Return the ids of the cached problems."""
+        return list(self._tasks.keys())
+
+    def remove(self, problem):
+        with self._lock:
+            self._tasks.pop(problem, None)
+
+    def warm(self, problem):
+        """Return the task for the given problem id without marking it as
+        used, create it if needed."""
+        with self._lock:
+            task = self._tasks.get(problem)
+            if task is None:
+                task = Task.new(problem)
+                # Prefetched tasks are the first candidates for eviction
+                items = list(self._tasks.items())
+                self._tasks.clear()
+                self._tasks[problem] = task
+                self._tasks.update(items)
+        return task
+
+    def get(self, problem):
+        """Return the task for the given problem id, create it if needed."""
+        with self._lock:
+            task = self._tasks.pop(problem, None)
+            if task is None:
+                self.stats['misses'] += 1
+                CACHE_REQUESTS.inc(cache='task', result='miss')
+                task = Task.new(problem)
+            else:
+                self.stats['hits'] += 1
+                CACHE_REQUESTS.inc(cache='task', result='hit')
+            # Most recently used tasks are kept at the end
+            self._tasks[problem] = task
+            task.lastUseTime = time()
+            self._evict(keep=problem)
+        return task
+
+    @property
+    def size(self):
+        return sum(task.size for task in list(self._tasks.values()))
+
+    def evict(self):
+        """Evict tasks until the limits are satisfied."""
+        with self._lock:
+            self._evict()
+
+    def _overflow(self):
+        return self.size > self.maxSize or \
+            get_free_memory() < self.minFreeMemory
+
+    def _evict(self, keep=None):
+        for problem in list(self._tasks.keys()):
+            if problem == keep or not self._overflow():
+                break
+            del self._tasks[problem]
+            self.stats['evictions'] += 1
+            logging.info("Task {} evicted from memory.".format(problem))
+
+
 class FileTask(Task):
-    """Task which loads tests from local filesystem files."""
-    pass
+    """Task which loads tests from local filesystem files. The tests
+    of a problem are stored as
 
+        in/<problem>/<test>     test inputs
+        ref/<problem>/<test>    reference outputs
+        conf/<problem>/memory   memory limit in kb
+        conf/<problem>/time     time limit in seconds
+        conf/<problem>/sample   optional names of sample tests
+        conf/<problem>/problem  optional problem wide options in JSON
 
-class RESTTask(Task):
-    """Task which loads tests from the REST web service."""
+    under NODE['TEST_PATH']. Tests are ordered by their names with numbers
+    compared by value, e.g. 2 before 10. Test files are indexed by their
+    modification time and size and only the changed ones are reloaded.
+    Reference outputs are read when first used."""
 
     def __init__(self, problem):
         self.problem = problem
         self._tests = {}
-        self.timestamp = [0, 0, 0]
+        # Modification time and size of every indexed file
+        self._index = {}
+        self.timestamp = []
+        self.checkTime = 0
+        self._lock = threading.Lock()
 
     @property
     def tests(self):
-        self._check_updates()
-        return self._tests
+        with self._lock:
+            if time() - self.checkTime >= NODE['TEST_CHECK_TTL'] or \
+               not self._tests:
+                with measure('check_updates'):
+                    self._check_updates()
+                self.checkTime = time()
+            return self._tests
 
     @tests.setter
     def tests(self, value):
         self._tests = value
 
+    @property
+    def size(self):
+        return sum(test.size for test in list(self._tests.values()))
+
+    @property
+    def version(self):
+        if not self._index:
+            return None
+        return tuple(sorted(self._index.items()))
+
+    def __get_path(self, kind, name=''):
+        return os.path.join(NODE['TEST_PATH'], kind, self.problem, name)
+
+    def __scan(self, kind):
+        """Return the modification time and size of the files
+        of the given kind."""
+        path = self.__get_path(kind)
+        if not os.path.isdir(path):
+            return {}
+        files = {}
+        for name in os.listdir(path):
+            stat = os.stat(os.path.join(path, name))
+            files[name] = (stat.st_mtime, stat.st_size)
+        return files
+
+    def __read_conf(self, name, default=None):
+        path = self.__get_path('conf', name)
+        if not os.path.exists(path):
+            return default
+        with open(path, 'r') as confFile:
+            return confFile.read().strip()
+
     def _check_updates(self):
-        """Check if tests are up-to-date, if not download new ones."""
+        """Index the test files and reload the changed ones."""
         logging.info("Checking if tests are up-to-date.")
-        inpt_path = self.__get_test_path(
-            NODE['TEST_PATH'], self.problem, 'input')
-        out_path = self.__get_test_path(
-            NODE['TEST_PATH'], self.problem, 'output')
-        conf_path = self.__get_test_path(
-            NODE['TEST_PATH'], self.problem, 'config')
+        index = {}
+        for kind in ('in', 'ref', 'conf'):
+            for name, stat in self.__scan(kind).items():
+                index[(kind, name)] = stat
 
-        if not os.path.exists(inpt_path) or not os.path.exists(out_path) or \
-           not os.path.exists(conf_path):
-            logging.info(
+        if not any(kind == 'in' for kind, name in index):
+            logging.error(
                 "Tests for problem {} do not exist.".format(self.problem)
             )
-            self._load_tests()
-        else:
-            data = RESTConnection.get_test_timestamps(self.problem)
-
-            inpt_time = iso_to_datetime(data['input'])
-            out_time = iso_to_datetime(data['output'])
-            conf_time = iso_to_datetime(data['config'])
-
-            if get_file_modification_date(inpt_path) < inpt_time or \
-               get_file_modification_date(out_path) < out_time or \
-               get_file_modification_date(conf_path) < conf_time:
-                logging.info(
-                    "Tests for problem {} outdated.".format(self.problem)
+            raise NotFoundException()
+
+        if index == self._index:
+            return
+        self._load_tests(index)
+
+    def _load_tests(self, index):
+        """Create the tests which have changed since the last indexing."""
+        logging.info("Updating tests for problem {}.".format(self.problem))
+
+        confChanged = any(index.get(key) != self._index.get(key)
+                          for key in set(index) | set(self._index)
+                          if key[0] == 'conf')
+        if confChanged:
+            problemConf = self.__read_conf('problem')
+            self.config = json.loads(problemConf) if problemConf else {}
+        memory = int(self.__read_conf('memory'))
+        timeLimit = int(self.__read_conf('time'))
+        samples = set(self.__read_conf('sample', '').split())
+
+        tests = OrderedDict()
+        names = sorted((name for kind, name in index if kind == 'in'),
+                       key=natural_key)
+        for name in names:
+            test = self._tests.get(name)
+            if test is None or confChanged or \
+               index[('in', name)] != self._index.get(('in', name)) or \
+               index.get(('ref', name)) != self._index.get(('ref', name)):
+                test = FileTest(
+                    inputPath=self.__get_path('in', name),
+                    outputPath=self.__get_path('ref', name),
+                    memoryLimit=memory,
+                    timeLimit=timeLimit,
+                    isSampleTest=name in samples
                 )
-                self._remove_tests()
-                self._load_tests()
-            logging.info(
-                "Tests for problem {} are up-to-date.".format(self.problem)
-            )
+            tests[name] = test
 
+        # Replace the tests at once, judges may still use the old ones
+        self._tests = tests
+        self._index = index
+        self.timestamp = sorted(index.items())
+        logging.info("Tests for problem {} loaded.".format(self.problem))
+
+
+class RESTTask(Task):
+    """Task which loads tests from the REST web service."""
+
+    # Name of the config archive member with the problem wide options
+    PROBLEM_CONFIG = 'problem'
+    TEST_TYPES = ('input', 'output', 'config', 'checker')
+
+    # Problem id -> lock of its files, shared by all the tasks of the
+    # problem, e.g. with one evicted from the cache while still downloading
+    _problemLocks = weakref.WeakValueDictionary()
+    _problemLocksLock = threading.Lock()
+
+    def __init__(self, problem):
+        self.problem = problem
+        self._tests = {}
+        # Modification times of the archives the tests were parsed from
+        self.timestamp = [0] * len(self.TEST_TYPES)
+        # Time of the last check against the Supervisor
+        self.checkTime = 0
+        # Tests may be requested by many workers at the same time
+        self._lock = self.__problem_lock(problem)
+        # Limits the downloads while the tests are prefetched
+        self._rateLimiter = None
+        # Set while the config archive is up-to-date, the tests are known
+        # from it before the inputs and outputs arrive
+        self._configured = threading.Event()
+
+    @property
+    def tests(self):
+        # A submission needs the tests, stop limiting a running prefetch
+        self._rateLimiter = None
+        with self._lock:
+            if time() - self.checkTime >= NODE['TEST_CHECK_TTL'] or \
+               not self._tests:
+                with measure('check_updates'):
+                    self._check_updates()
+                self.checkTime = time()
+            return self._tests
+
+    def warm(self, rateLimiter=None):
+        with self._lock:
+            self._rateLimiter = rateLimiter
+            try:
+                if time() - self.checkTime >= NODE['TEST_CHECK_TTL'] or \
+                   not self._tests:
+                    with measure('prefetch'):
+                        self._check_updates()
+                    self.checkTime = time()
+            finally:
+                self._rateLimiter = None
+            return self._tests
+
+    @classmethod
+    def __problem_lock(cls, problem):
+        with cls._problemLocksLock:
+            lock = cls._problemLocks.get(problem)
+            if lock is None:
+                lock = threading.Lock()
+                cls._problemLocks[problem] = lock
+            return lock
+
+    def sample_flags(self):
+        """Read the flags from the config archive once it is up-to-date,
+        without waiting for the inputs and outputs."""
+        self._configured.wait()
+        path = self.__get_test_path(NODE['TEST_PATH'], self.problem, 'config')
+        storePath = self.__get_store_path(
+            NODE['TEST_PATH'], self.problem, 'config')
+        flags = []
+        try:
+            versionPath = os.path.join(storePath, archive_version(path))
+            for name in read_members(versionPath) or []:
+                if name == self.PROBLEM_CONFIG:
+                    continue
+                with open(os.path.join(versionPath, name), 'rb') as conf:
+                    data = json.loads(conf.read().decode('utf-8'))
+                flags.append(bool(int(data['sample'])))
+        except (IOError, OSError):
+            # Not downloaded or replaced by a newer version meanwhile
+            return None
+        return flags
+
+    def __throttle(self, size):
+        rateLimiter = self._rateLimiter
+        if rateLimiter is not None:
+            rateLimiter.consume(size)
+
+    @tests.setter
+    def tests(self, value):
+        self._tests = value
+
+    @property
+    def size(self):
+        size = 0
+        for test in list(self._tests.values()):
+            size += len(test.input or b'') + len(test.output or b'')
+        return size
+
+    @property
+    def version(self):
+        if not self._tests:
+            return None
+        return tuple(self.timestamp)
+
+    def _check_updates(self):
+        """Check if tests are up-to-date, if not download new ones."""
+        logging.info("Checking if tests are up-to-date.")
+        self._load_tests()
+
+        paths = [
+            self.__get_test_path(NODE['TEST_PATH'], self.problem, testType)
+            for testType in ('config', 'output', 'input', 'checker')
+        ]
+        timestamp = [os.path.getmtime(path) if os.path.exists(path) else 0
+                     for path in paths]
+        if timestamp != self.timestamp:
+            # Parse the archives only if they have changed
+            self.__fill_tests(*paths[:3])
+            self.__load_checker(paths[3])
+            self.timestamp = timestamp
         logging.info("Tests for problem {} loaded.".format(self.problem))
-        self.__fill_tests(
-            self.__get_test_path(NODE['TEST_PATH'], self.problem, 'config'),
-            self.__get_test_path(NODE['TEST_PATH'], self.problem, 'output'),
-            self.__get_test_path(NODE['TEST_PATH'], self.problem, 'input')
-        )
 
     @staticmethod
     def __get_test_path(path, problem, testType):
         """Creates an absolute path to the test file."""
         return os.path.join(path, problem, testType + '.tar.gz')
 
-    def _remove_tests(self):
-        """Remove all test files for a given task."""
-        logging.info("Removing old tests for problem {}.".format(self.problem))
-
-        inpt_path = self.__get_test_path(
-                NODE['TEST_PATH'], self.problem, 'input')
-        os.remove(inpt_path)
-
-        out_path = self.__get_test_path(
-                NODE['TEST_PATH'], self.problem, 'output')
-        os.remove(out_path)
+    @staticmethod
+    def __get_store_path(path, problem, testType):
+        """Creates an absolute path to the directory with the versions
+        of extracted tests."""
+        return os.path.join(path, problem, testType)
 
-        conf_path = self.__get_test_path(
-                NODE['TEST_PATH'], self.problem, 'config')
-        os.remove(conf_path)
+    @staticmethod
+    def __extract(archivePath, storePath):
+        """Return the directory with the test files of the current version
+        of the archive, extract them there if they are not yet."""
+        versionPath = os.path.join(storePath, archive_version(archivePath))
+        if read_members(versionPath) is not None:
+            return versionPath
+
+        logging.info("Extracting {} to {}.".format(archivePath, versionPath))
+        tmpPath = os.path.join(storePath, '.extracting')
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        os.makedirs(tmpPath)
+        with open(archivePath, 'rb') as archive:
+            extract_archive(archive, tmpPath)
+
+        shutil.rmtree(versionPath, ignore_errors=True)
+        os.rename(tmpPath, versionPath)
+        return versionPath
 
+    @staticmethod
+    def __list_store(storePath):
+        """Return the names of the test files in the store directory
+        in the order of the archive members. Results are sent without
+        the test names, so the tests must keep this order."""
+        return read_members(storePath) or []
 
     def _load_tests(self):
-        """Load tests from REST webservice and save them as files."""
+        """Load tests from REST webservice and save them as files.
+        The archives are requested in parallel and only the modified
+        ones are downloaded."""
 
         logging.info("Updating tests for problem {}.".format(self.problem))
 
-        inpt_path = self.__get_test_path(
-            NODE['TEST_PATH'], self.problem, 'input')
-        RESTConnection.get_tests(
-            problem=self.problem,
-            testType='input',
-            path=inpt_path
-        )
-
-        out_path = self.__get_test_path(
-            NODE['TEST_PATH'], self.problem, 'output')
-        RESTConnection.get_tests(
-            problem=self.problem,
-            testType='output',
-            path=out_path
-        )
-
-        conf_path = self.__get_test_path(
-            NODE['TEST_PATH'], self.problem, 'config')
-        RESTConnection.get_tests(
-            problem=self.problem,
-            testType='config',
-            path=conf_path
+        self._configured.clear()
+        pool = ThreadPool(len(self.TEST_TYPES))
+        try:
+            others = pool.map_async(
+                self.__load_archive,
+                [testType for testType in self.TEST_TYPES
+                 if testType != 'config']
+            )
+            try:
+                self.__load_archive('config')
+            finally:
+                self._configured.set()
+            others.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    def __load_archive(self, testType):
+        path = self.__get_test_path(NODE['TEST_PATH'], self.problem, testType)
+        # All the archives but the checker are extracted while downloading
+        storePath = None
+        if testType != 'checker':
+            storePath = self.__get_store_path(
+                NODE['TEST_PATH'], self.problem, testType)
+        try:
+            RESTConnection.get_tests(
+                problem=self.problem,
+                testType=testType,
+                path=path,
+                storePath=storePath,
+                throttle=self.__throttle
+            )
+        except NotFoundException:
+            if testType != 'checker':
+                raise
+            # The checker is optional
+            logging.info(
+                "Problem {} has no checker.".format(self.problem)
+            )
+            for leftover in (path, path + '.validators'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def __load_checker(self, check_path):
+        """Compile the checker of the problem if it has one."""
+        if not os.path.exists(check_path):
+            self.checker = None
+            return
+        checker = Checker(
+            self.problem,
+            check_path,
+            self.__get_store_path(NODE['TEST_PATH'], self.problem, 'checker')
         )
+        checker.prepare()
+        self.checker = checker
 
     def __fill_tests(self, conf_path, out_path, inpt_path):
-        """Fill the tests dict with the Test objects from tar files."""
-
-        with tarfile.open(conf_path, mode='r') as conf:
-            for tarinfo in conf:
-                data = conf.extractfile(tarinfo).read()
-                data = json.loads(data.decode('utf-8'))
-                memory = int(data['memory'])
-                time = int(data['time'])
-                sample = bool(int(data['sample']))
-                test = Test(memoryLimit=memory, timeLimit=time,
-                            isSampleTest=sample)
-                self._tests.update({tarinfo.name: test})
-
-        with tarfile.open(inpt_path, mode='r') as inpt:
-            for tarinfo in inpt:
-                data = inpt.extractfile(tarinfo).read()
-                self._tests[tarinfo.name].input = data
-
-        with tarfile.open(out_path, mode='r') as out:
-            for tarinfo in out:
-                data = out.extractfile(tarinfo).read().decode('utf-8')
-                self._tests[tarinfo.name].output = data
+        """Fill the tests dict with the Test objects from the test files
+        extracted from the tar files."""
+
+        archives = [
+            (path, self.__get_store_path(NODE['TEST_PATH'], self.problem,
+                                         testType))
+            for path, testType in ((conf_path, 'config'),
+                                   (out_path, 'output'),
+                                   (inpt_path, 'input'))
+        ]
+        # Archives are normally extracted while they are downloaded
+        conf_store, out_store, inpt_store = [
+            self.__extract(path, store) for path, store in archives
+        ]
+        inputs = TestStore.get(inpt_store, inpt_path)
+
+        tests = OrderedDict()
+        config = {}
+        for name in self.__list_store(conf_store):
+            with open(os.path.join(conf_store, name), 'rb') as conf:
+                data = json.loads(conf.read().decode('utf-8'))
+            if name == self.PROBLEM_CONFIG:
+                config = data
+                continue
+            memory = int(data['memory'])
+            time = int(data['time'])
+            sample = bool(int(data['sample']))
+            test = Test(memoryLimit=memory, timeLimit=time,
+                        isSampleTest=sample, group=data.get('group'))
+            tests.update({name: test})
+
+        # Inputs are kept on disk and given to the program as its stdin
+        for name, test in tests.items():
+            test.inputPath = os.path.join(inpt_store, name)
+            test.store = inputs
+
+        for name in self.__list_store(out_store):
+            # Outputs are compared as bytes, without decoding
+            with open(os.path.join(out_store, name), 'rb') as out:
+                tests[name].output = out.read()
+
+        # Replace the tests at once, judges may still use the old ones
+        self._tests = tests
+        self.config = config
+
+        # Configs and outputs are in memory, inputs are removed once
+        # the judges using them finish
+        for path, store in archives:
+            TestStore.remove_outdated(store, path)
+
+
+class TestStore(object):
+    """Directory with the test files extracted from one version of an
+    archive. Tests refer to it while they may use its files and an outdated
+    version is removed together with the last reference, so the files are
+    never replaced under a running judge."""
+
+    # Path -> TestStore of the versions referred to by some tests
+    _used = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __init__(self, path, archivePath):
+        self.path = path
+        self.archivePath = archivePath
+
+    @classmethod
+    def get(cls, path, archivePath):
+        """Return the TestStore of the version in the given directory."""
+        with cls._lock:
+            store = cls._used.get(path)
+            if store is None:
+                store = cls(path, archivePath)
+                cls._used[path] = store
+            return store
+
+    @staticmethod
+    def _outdated(path, archivePath):
+        try:
+            return os.path.basename(path) != archive_version(archivePath)
+        except OSError:
+            # The archive has been removed
+            return True
+
+    @classmethod
+    def remove_outdated(cls, storePath, archivePath):
+        """Remove the versions in the store directory which are neither
+        current nor used by any tests."""
+        with cls._lock:
+            for name in os.listdir(storePath):
+                path = os.path.join(storePath, name)
+                if not name.startswith('.') and path not in cls._used and \
+                   cls._outdated(path, archivePath):
+                    logging.info("Removing outdated tests {}.".format(path))
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def __del__(self):
+        try:
+            if self._outdated(self.path, self.archivePath):
+                shutil.rmtree(self.path, ignore_errors=True)
+        except Exception:
+            # The interpreter may be shutting down
+            pass
@@ -6,13 +6,45 @@ class Test(object):
 
     def __init__(self, *args, **kwargs):
         self.input = kwargs.get('input')
+        # Path of the file with the input, used instead of the input data
+        self.inputPath = kwargs.get('inputPath')
         self.output = kwargs.get('output')
         self.memoryLimit = kwargs.get('memoryLimit')
         self.timeLimit = kwargs.get('timeLimit')
         self.isSampleTest = kwargs.get('isSampleTest')
+        # Tests of a group may be skipped once one of them fails
+        self.group = kwargs.get('group')
+        # Keeps the directory with the input file from being removed
+        self.store = kwargs.get('store')
 
     def __repr__(self):
         out = "Test(input={}, output={}, memoryLimit={}, " \
                 + "timeLimit={}, isSampleTest={})"
-        return out.format(self.input.strip(), self.output.strip(),
+        inpt = self.inputPath if self.input is None else self.input.strip()
+        return out.format(inpt, self.output.strip(),
                           self.memoryLimit, self.timeLimit, self.isSampleTest)
+
+
+class FileTest(Test):
+    """Test whose reference output is read from a file when first used."""
+
+    def __init__(self, *args, **kwargs):
+        self.outputPath = kwargs.get('outputPath')
+        self._output = None
+        super(FileTest, self).__init__(*args, **kwargs)
+
+    @property
+    def output(self):
+        if self._output is None and self.outputPath is not None:
+            with open(self.outputPath, 'rb') as outputFile:
+                self._output = outputFile.read()
+        return self._output
+
+    @output.setter
+    def output(self, value):
+        self._output = value
+
+    @property
+    def size(self):
+        """Number of bytes of the output held in memory."""
+        return len(self._output or b'')
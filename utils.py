@@ -2,6 +2,14 @@
 from datetime import datetime
 from tzlocal import get_localzone
 import os
+import re
+import json
+import random
+import threading
+import time
+import shutil
+import tarfile
+import logging
 
 
 def iso_to_datetime(iso):
@@ -13,7 +21,135 @@ def get_file_modification_date(filename):
     return datetime.fromtimestamp(t, tz=get_localzone())
 
 def get_free_memory():
+    """Return the memory in kb available for new allocations."""
+    info = {}
     with open('/proc/meminfo', 'r') as mem:
-        total, free, buffers, cached = [int(next(mem).split()[1])
-                                        for x in xrange(4)]
-        return free + cached
+        for line in mem:
+            name, value = line.split(':', 1)
+            info[name] = int(value.split()[0])
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    return info['MemFree'] + info.get('Buffers', 0) + info.get('Cached', 0)
+
+
+class Backoff(object):
+    """Exponential backoff with full jitter. Every call to next returns
+    a random delay up to a limit which doubles each time, reset brings
+    the delay back to zero."""
+
+    def __init__(self, base, maximum):
+        self.base = base
+        self.maximum = maximum
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self):
+        limit = min(self.maximum, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(0, limit)
+
+
+class RateLimiter(object):
+    """Token bucket limiting the rate of a shared resource, e.g. the number
+    of bytes per second downloaded by many threads."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updateTime = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Wait until the given amount may be used."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updateTime) * self.rate)
+            self.updateTime = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+# File listing the extracted members in the order of the archive
+MEMBERS_INDEX = '.members'
+
+
+def extract_archive(fileobj, path):
+    """Extract the regular files of a tar archive read as a stream from
+    the file object into the given directory. Their names are saved in
+    the order of the archive to the MEMBERS_INDEX file of the directory,
+    see read_members."""
+    names = []
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for tarinfo in archive:
+            name = os.path.normpath(tarinfo.name)
+            if not tarinfo.isfile() or os.path.isabs(name) or \
+               name.startswith(os.pardir) or name == MEMBERS_INDEX:
+                logging.warning("Skipping archive member {}.".format(
+                    tarinfo.name))
+                continue
+            filePath = os.path.join(path, name)
+            if not os.path.exists(os.path.dirname(filePath)):
+                os.makedirs(os.path.dirname(filePath))
+            with open(filePath, 'wb') as memberFile:
+                shutil.copyfileobj(archive.extractfile(tarinfo), memberFile,
+                                   1024 * 1024)
+            if name not in names:
+                names.append(name)
+    with open(os.path.join(path, MEMBERS_INDEX), 'w') as indexFile:
+        json.dump(names, indexFile)
+    return names
+
+
+def archive_version(path):
+    """Name of the store directory with the files extracted from the
+    current version of the archive, see task.TestStore."""
+    return '{:.6f}'.format(os.path.getmtime(path))
+
+
+def read_members(path):
+    """Return the names of the files extracted into the directory
+    in the order of the archive, None if the order is not known."""
+    try:
+        with open(os.path.join(path, MEMBERS_INDEX), 'r') as indexFile:
+            return json.load(indexFile)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def natural_key(name):
+    """Sort key ordering the numbers in names by their value,
+    e.g. test 2 before test 10."""
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part)
+            for part in re.split(r'(\d+)', name) if part]
+
+
+class ChunkReader(object):
+    """File-like object reading from an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.position = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.position >= len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                self.position = 0
+                if self.chunk is None:
+                    self.chunk = b''
+                    break
+            end = len(self.chunk) if size < 0 else self.position + size
+            part = self.chunk[self.position:end]
+            self.position += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+        return b''.join(parts)